@@ -21,30 +21,16 @@ import kicad_netlist_reader
 import csv
 import sys
 
-def myEqu(self, other):
-    """myEqu is a more advanced equivalence function for components which is
+def groupKey(component):
+    """groupKey is a more advanced grouping key for components which is
     used by component grouping. Normal operation is to group components based
     on their value and footprint.
 
-    In this example of a custom equivalency operator we compare the
-    value, the part name and the footprint.
+    In this example of a custom grouping key we compare the
+    value, the part name, the footprint and the DNP field.
     """
-    result = True
-    if self.getValue() != other.getValue():
-        result = False
-    elif self.getPartName() != other.getPartName():
-        result = False
-    elif self.getFootprint() != other.getFootprint():
-        result = False
-    elif self.getField("DNP") !=  other.getField("DNP"):
-        result = False
-
-    return result
-
-# Override the component equivalence operator - it is important to do this
-# before loading the netlist, otherwise all components will have the original
-# equivalency operator.
-kicad_netlist_reader.comp.__eq__ = myEqu
+    return (component.getValue(), component.getPartName(),
+            component.getFootprint(), component.getField("DNP"))
 
 if len(sys.argv) != 3:
     print("Usage ", __file__, "<generic_netlist.xml> <output.csv>", file=sys.stderr)
@@ -52,8 +38,9 @@ if len(sys.argv) != 3:
 
 
 # Generate an instance of a generic netlist, and load the netlist tree from
-# the command line option. If the file doesn't exist, execution will stop
-net = kicad_netlist_reader.netlist(sys.argv[1])
+# the command line option. If the file doesn't exist, execution will stop.
+# The BOM does not need the nets, so they are not read.
+net = kicad_netlist_reader.netlist(sys.argv[1], fast=True, skipNets=True)
 
 # Open a file to write to, if the file cannot be opened output to stdout
 # instead
@@ -100,7 +87,7 @@ writerow( out, columns )
 
 # Get all of the components in groups of matching parts + values
 # (see kicad_netlist_reader.py)
-grouped = net.groupComponents(components)
+grouped = net.groupComponents(components, key=groupKey)
 grouped = sorted(grouped, key=lambda g: g[0].getField("DNP"))
 
 # Output component information organized by group, aka as collated:
@@ -17,8 +17,11 @@
 
 
 from __future__ import print_function
+from array import array
+import gc
 import sys
 import xml.sax as sax
+import xml.etree.ElementTree as ElementTree
 import re
 import pdb
 
@@ -82,6 +85,9 @@ class xmlElement():
         self.chars = ""
         self.children = []
 
+        # name -> children with that name, see indexChildren()
+        self._childIndex = None
+
     def __str__(self):
         """String representation of this netlist element
 
@@ -186,8 +192,21 @@ class xmlElement():
     def addChild(self, child):
         """Add a child element to this element"""
         self.children.append(child)
+        if self._childIndex is not None:
+            self._childIndex.setdefault(child.name, []).append(child)
         return self.children[len(self.children) - 1]
 
+    def indexChildren(self):
+        """Index the children of this element by name, so getChild() and
+        getChildren() do not have to search them.  The netlist reader does this
+        when the element ends, children added later are indexed as they are
+        added.
+        """
+        index = {}
+        for child in self.children:
+            index.setdefault(child.name, []).append(child)
+        self._childIndex = index
+
     def getParent(self):
         """Get the parent of this element (Could be None)"""
         return self.parent
@@ -197,6 +216,9 @@ class xmlElement():
 
         Keywords:
         name -- The name of the child element to return"""
+        if self._childIndex is not None:
+            children = self._childIndex.get(name)
+            return children[0] if children else None
         for child in self.children:
             if child.name == name:
                 return child
@@ -205,6 +227,8 @@ class xmlElement():
     def getChildren(self, name=None):
         if name:
             # return _all_ children named "name"
+            if self._childIndex is not None:
+                return list(self._childIndex.get(name, []))
             ret = []
             for child in self.children:
                 if child.name == name:
@@ -213,6 +237,17 @@ class xmlElement():
         else:
             return self.children
 
+    def iterElements(self, name=None):
+        """Yield this element and every element below it in document order,
+        or only those named 'name'
+        """
+        stack = [self]
+        while stack:
+            element = stack.pop()
+            if name is None or element.name == name:
+                yield element
+            stack.extend(reversed(element.children))
+
     def get(self, elemName, attribute="", attrmatch=""):
         """Return the text data for either an attribute or an xmlElement
         """
@@ -249,7 +284,62 @@ class xmlElement():
 
 
 
-class libpart():
+class _cachedElement():
+    """Base of the classes wrapping an xmlElement, which remembers the
+    values looked up in the element so each is only searched for once.
+    The element must not change after the first lookup, except through
+    methods which call clearCache().
+    """
+    def __init__(self, xml_element):
+        self.element = xml_element
+        self.clearCache()
+
+    def clearCache(self):
+        """Forget all remembered values"""
+        self._values = {}
+        self._fields = None
+        self._fieldNames = None
+
+    def _get(self, elemName, attribute=""):
+        """Return self.element.get(elemName, attribute), remembering it"""
+        key = (elemName, attribute)
+        try:
+            return self._values[key]
+        except KeyError:
+            ret = self._values[key] = self.element.get(elemName, attribute)
+            return ret
+
+    def _getField(self, name):
+        """Return self.element.get("field", "name", name) from a dictionary of
+        all fields, built on first use
+        """
+        if self._fields is None:
+            # The first non-empty field of each name in document order, as
+            # found by xmlElement.get()
+            fields = {}
+            for f in self.element.iterElements("field"):
+                fieldName = f.attributes.get("name")
+                if f.chars != "" and fieldName not in fields:
+                    ret = f.chars
+                    if type(ret) != str: ret = ret.encode('utf-8')
+                    fields[fieldName] = ret
+            self._fields = fields
+        return self._fields.get(name, "")
+
+    def getFieldNames(self):
+        """Return a list of field names in play for this element.
+        """
+        if self._fieldNames is None:
+            fieldNames = []
+            fields = self.element.getChild('fields')
+            if fields:
+                for f in fields.getChildren():
+                    fieldNames.append( f.get('field','name') )
+            self._fieldNames = fieldNames
+        return list(self._fieldNames)
+
+
+class libpart(_cachedElement):
     """Class for a library part, aka 'libpart' in the xml netlist file.
     (Components in eeschema are instantiated from library parts.)
     This part class is implemented by wrapping an xmlElement with accessors.
@@ -257,33 +347,23 @@ class libpart():
     """
     def __init__(self, xml_element):
         #
-        self.element = xml_element
+        _cachedElement.__init__(self, xml_element)
 
     #def __str__(self):
         # simply print the xmlElement associated with this part
         #return str(self.element)
 
     def getLibName(self):
-        return self.element.get("libpart", "lib")
+        return self._get("libpart", "lib")
 
     def getPartName(self):
-        return self.element.get("libpart", "part")
+        return self._get("libpart", "part")
 
     def getDescription(self):
-        return self.element.get("description")
+        return self._get("description")
 
     def getField(self, name):
-        return self.element.get("field", "name", name)
-
-    def getFieldNames(self):
-        """Return a list of field names in play for this libpart.
-        """
-        fieldNames = []
-        fields = self.element.getChild('fields')
-        if fields:
-            for f in fields.getChildren():
-                fieldNames.append( f.get('field','name') )
-        return fieldNames
+        return self._getField(name)
 
     def getDatasheet(self):
         return self.getField("Datasheet")
@@ -293,25 +373,28 @@ class libpart():
 
     def getAliases(self):
         """Return a list of aliases or None"""
-        aliases = self.element.getChild("aliases")
-        if aliases:
-            ret = []
-            children = aliases.getChildren()
-            # grab the text out of each child:
-            for child in children:
-                ret.append( child.get("alias") )
-            return ret
-        return None
-
-
-class comp():
+        if "aliases" not in self._values:
+            aliases = self.element.getChild("aliases")
+            ret = None
+            if aliases:
+                ret = []
+                children = aliases.getChildren()
+                # grab the text out of each child:
+                for child in children:
+                    ret.append( child.get("alias") )
+            self._values["aliases"] = ret
+        ret = self._values["aliases"]
+        return list(ret) if ret is not None else None
+
+
+class comp(_cachedElement):
     """Class for a component, aka 'comp' in the xml netlist file.
     This component class is implemented by wrapping an xmlElement instance
     with accessors.  The xmlElement is held in field 'element'.
     """
 
     def __init__(self, xml_element):
-        self.element = xml_element
+        _cachedElement.__init__(self, xml_element)
         self.libpart = None
 
         # Set to true when this component is included in a component group
@@ -331,6 +414,9 @@ class comp():
                 kicad_netlist_reader.comp.__eq__ = myEqu
             in your bom generator script before calling the netliste reader by something like:
                 net = kicad_netlist_reader.netlist(sys.argv[1])
+
+            Comparing every pair of components is slow on large designs, it is
+            faster to pass a key function to netlist.groupComponents() instead.
         """
         result = False
         if self.getValue() == other.getValue():
@@ -345,19 +431,20 @@ class comp():
         return self.libpart
 
     def getPartName(self):
-        return self.element.get("libsource", "part")
+        return self._get("libsource", "part")
 
     def getLibName(self):
-        return self.element.get("libsource", "lib")
+        return self._get("libsource", "lib")
 
     def setValue(self, value):
         """Set the value of this component"""
         v = self.element.getChild("value")
         if v:
             v.setChars(value)
+            self.clearCache()
 
     def getValue(self):
-        return self.element.get("value")
+        return self._get("value")
 
     def getField(self, name, libraryToo=True):
         """Return the value of a field named name. The component is first
@@ -371,7 +458,7 @@ class comp():
                         in component itself
         """
 
-        field = self.element.get("field", "name", name)
+        field = self._getField(name)
         if field == "" and libraryToo and self.libpart:
             field = self.libpart.getField(name)
         return field
@@ -382,33 +469,175 @@ class comp():
         The netlist format only includes fields with non-empty values.  So if a field
         is empty, it will not be present in the returned list.
         """
-        fieldNames = []
-        fields = self.element.getChild('fields')
-        if fields:
-            for f in fields.getChildren():
-                fieldNames.append( f.get('field','name') )
-        return fieldNames
+        return _cachedElement.getFieldNames(self)
 
     def getRef(self):
-        return self.element.get("comp", "ref")
+        return self._get("comp", "ref")
 
     def getFootprint(self, libraryToo=True):
-        ret = self.element.get("footprint")
+        ret = self._get("footprint")
         if ret == "" and libraryToo and self.libpart:
             ret = self.libpart.getFootprint()
         return ret
 
     def getDatasheet(self, libraryToo=True):
-        ret = self.element.get("datasheet")
+        ret = self._get("datasheet")
         if ret == "" and libraryToo and self.libpart:
             ret = self.libpart.getDatasheet()
         return ret
 
     def getTimestamp(self):
-        return self.element.get("tstamp")
+        return self._get("tstamp")
 
     def getDescription(self):
-        return self.element.get("libsource", "description")
+        return self._get("libsource", "description")
+
+
+class netIndex():
+    """Index of the component pins connected by each net, built from the net
+    elements as they are read.  Refs, pins and net names are numbered, and the
+    connections are held in arrays of those numbers, so nets can be looked up
+    by name or code, and pins by ref or by ref and pin, without walking the
+    xml tree.
+    """
+    def __init__(self):
+        self.netNames = []
+        self.netCodes = array('l')
+        self.refNames = []
+        self.pinNames = []
+
+        # name or code -> net number, the first net wins if they repeat
+        self._netIds = {}
+        self._netCodeIds = {}
+        self._refIds = {}
+        self._pinIds = {}
+
+        # Nodes are numbered in the order they are added.  The nodes of net i
+        # are numbers _netStart[i] to _netStart[i + 1] - 1
+        self._netStart = array('l', [0])
+        self._nodeNet = array('l')
+        self._nodeRef = array('l')
+        self._nodePin = array('l')
+
+        # The nodes of each ref in the same form, built when first needed
+        self._refStart = None
+        self._refNodes = None
+
+    def _number(self, names, ids, name):
+        i = ids.get(name)
+        if i is None:
+            i = ids[name] = len(names)
+            names.append(name)
+        return i
+
+    def addNet(self, code, name, nodes):
+        """Add a net and the (ref, pin) pairs it connects"""
+        net = len(self.netNames)
+        self.netNames.append(name)
+        self.netCodes.append(code)
+        self._netIds.setdefault(name, net)
+        self._netCodeIds.setdefault(code, net)
+        for ref, pin in nodes:
+            self._nodeNet.append(net)
+            self._nodeRef.append(self._number(self.refNames, self._refIds, ref))
+            self._nodePin.append(self._number(self.pinNames, self._pinIds, pin))
+        self._netStart.append(len(self._nodeRef))
+        self._refStart = None
+
+    def addNetElement(self, element):
+        """Add a complete net xmlElement and its node children"""
+        nodes = []
+        for node in element.getChildren("node"):
+            nodes.append((node.attributes.get("ref", ""),
+                          node.attributes.get("pin", "")))
+        self.addNet(int(element.attributes.get("code", "-1")),
+                    element.attributes.get("name", ""), nodes)
+
+    def _buildRefIndex(self):
+        """Sort the node numbers by ref, with a counting sort"""
+        start = array('l', [0]) * (len(self.refNames) + 1)
+        for ref in self._nodeRef:
+            start[ref + 1] += 1
+        for ref in range(len(self.refNames)):
+            start[ref + 1] += start[ref]
+
+        fill = start[:-1]
+        nodes = array('l', [0]) * len(self._nodeRef)
+        for node, ref in enumerate(self._nodeRef):
+            nodes[fill[ref]] = node
+            fill[ref] += 1
+
+        self._refStart = start
+        self._refNodes = nodes
+
+    def _netNodes(self, net):
+        if net is None:
+            return []
+        return [(self.refNames[self._nodeRef[node]],
+                 self.pinNames[self._nodePin[node]])
+                for node in range(self._netStart[net], self._netStart[net + 1])]
+
+    def _refNodeRange(self, ref):
+        ref = self._refIds.get(ref)
+        if ref is None:
+            return []
+        if self._refStart is None:
+            self._buildRefIndex()
+        return self._refNodes[self._refStart[ref]:self._refStart[ref + 1]]
+
+    def getNetNames(self):
+        """Return the names of all nets, in the order they were read"""
+        return list(self.netNames)
+
+    def getNetCode(self, name):
+        """Return the code of the net named name, or None"""
+        net = self._netIds.get(name)
+        return self.netCodes[net] if net is not None else None
+
+    def getNetName(self, code):
+        """Return the name of the net with the given code, or None"""
+        net = self._netCodeIds.get(code)
+        return self.netNames[net] if net is not None else None
+
+    def getNetNodes(self, name):
+        """Return the (ref, pin) pairs connected by the net named name"""
+        return self._netNodes(self._netIds.get(name))
+
+    def getNetNodesByCode(self, code):
+        """Return the (ref, pin) pairs connected by the net with a code"""
+        return self._netNodes(self._netCodeIds.get(code))
+
+    def getNetRefs(self, name):
+        """Return the refs of the components on the net named name, each
+        once, in the order they were read
+        """
+        refs = []
+        seen = set()
+        for ref, pin in self.getNetNodes(name):
+            if ref not in seen:
+                seen.add(ref)
+                refs.append(ref)
+        return refs
+
+    def getRefNets(self, ref):
+        """Return the (pin, net name) pairs of the connected pins of the
+        component ref
+        """
+        return [(self.pinNames[self._nodePin[node]],
+                 self.netNames[self._nodeNet[node]])
+                for node in self._refNodeRange(ref)]
+
+    def getPinNet(self, ref, pin):
+        """Return the name of the net connected to pin of the component ref,
+        or None if it is not connected
+        """
+        pin = self._pinIds.get(pin)
+        if pin is None:
+            return None
+        for node in self._refNodeRange(ref):
+            if self._nodePin[node] == pin:
+                return self.netNames[self._nodeNet[node]]
+        return None
 
 
 class netlist():
@@ -417,11 +646,13 @@ class netlist():
     scripts
 
     """
-    def __init__(self, fname=""):
+    def __init__(self, fname="", fast=False, skipNets=False):
         """Initialiser for the genericNetlist class
 
         Keywords:
         fname -- The name of the generic netlist file to open (Optional)
+        fast -- Load the file with loadFast() rather than load()
+        skipNets -- Do not read the nets, see loadFast()
 
         """
         self.design = None
@@ -430,6 +661,13 @@ class netlist():
         self.libraries = []
         self.nets = []
 
+        # Which pins each net connects, see netIndex
+        self.netIndex = netIndex()
+
+        # (library name, part name or alias) -> libpart, used to link
+        # components to their library parts
+        self._libpart_index = {}
+
         # The entire tree is loaded into self.tree
         self.tree = []
 
@@ -441,7 +679,10 @@ class netlist():
         self.excluded_footprints = []
 
         if fname != "":
-            self.load(fname)
+            if fast:
+                self.loadFast(fname, skipNets)
+            else:
+                self.load(fname)
 
     def addChars(self, content):
         """Add characters to the current element"""
@@ -456,27 +697,30 @@ class netlist():
             self._curr_element = self._curr_element.addChild(
                 xmlElement(name, self._curr_element))
 
+        self.registerElement(self._curr_element)
+        return self._curr_element
+
+    def registerElement(self, element):
+        """Add a new element to the list for its kind, if any"""
         # If this element is a component, add it to the components list
-        if self._curr_element.name == "comp":
-            self.components.append(comp(self._curr_element))
+        if element.name == "comp":
+            self.components.append(comp(element))
 
         # Assign the design element
-        if self._curr_element.name == "design":
-            self.design = self._curr_element
+        if element.name == "design":
+            self.design = element
 
         # If this element is a library part, add it to the parts list
-        if self._curr_element.name == "libpart":
-            self.libparts.append(libpart(self._curr_element))
+        if element.name == "libpart":
+            self.libparts.append(libpart(element))
 
         # If this element is a net, add it to the nets list
-        if self._curr_element.name == "net":
-            self.nets.append(self._curr_element)
+        if element.name == "net":
+            self.nets.append(element)
 
         # If this element is a library, add it to the libraries list
-        if self._curr_element.name == "library":
-            self.libraries.append(self._curr_element)
-
-        return self._curr_element
+        if element.name == "library":
+            self.libraries.append(element)
 
     def endDocument(self):
         """Called when the netlist document has been fully parsed"""
@@ -484,21 +728,33 @@ class netlist():
         # the components as they are seperate in the tree so as not to
         # duplicate library part information for every component
         for c in self.components:
-            for p in self.libparts:
-                if p.getLibName() == c.getLibName():
-                    if p.getPartName() == c.getPartName():
-                        c.setLibPart(p)
-                        break
-                    else:
-                        aliases = p.getAliases()
-                        if aliases and self.aliasMatch( c.getPartName(), aliases ):
-                            c.setLibPart(p)
-                            break;
+            p = self.findLibPart(c.getLibName(), c.getPartName())
+            if p:
+                c.setLibPart(p)
 
             if not c.getLibPart():
                 print( 'missing libpart for ref:', c.getRef(), c.getPartName(), c.getLibName() )
 
 
+    def indexLibPart(self, part):
+        """Add a library part to the index used by findLibPart(), under its
+        part name and each of its aliases.  Parts are indexed in the order
+        they appear, and a name already claimed by an earlier part is kept.
+        """
+        lib = part.getLibName()
+        names = [part.getPartName()]
+        aliases = part.getAliases()
+        if aliases:
+            names.extend(aliases)
+        for name in names:
+            if (lib, name) not in self._libpart_index:
+                self._libpart_index[(lib, name)] = part
+
+    def findLibPart(self, libName, partName):
+        """Return the first library part in library libName whose part name
+        or one of whose aliases is partName, or None"""
+        return self._libpart_index.get((libName, partName))
+
     def aliasMatch(self, partName, aliasList):
         for alias in aliasList:
             if partName == alias:
@@ -507,6 +763,14 @@ class netlist():
 
     def endElement(self):
         """End the current element and switch to its parent"""
+        # A library part's aliases are only known once all of its children
+        # have been read
+        if self._curr_element.name == "libpart":
+            self.indexLibPart(self.libparts[-1])
+        if self._curr_element.name == "net":
+            self.netIndex.addNetElement(self._curr_element)
+        if self._curr_element.children:
+            self._curr_element.indexChildren()
         self._curr_element = self._curr_element.getParent()
 
     def getDate(self):
@@ -626,13 +890,18 @@ class netlist():
         return ret
 
 
-    def groupComponents(self, components = None):
+    def groupComponents(self, components = None, key = None):
         """Return a list of component lists. Components are grouped together
         when the value, library and part identifiers match.
 
         Keywords:
         components -- is a list of components, typically an interesting subset
         of all components, or None.  If None, then all components are looked at.
+        key -- a function returning a hashable value, such as a tuple of
+        fields, for a component.  Components with equal keys are grouped
+        together in a single pass.  If None, components are compared with
+        comp.__eq__, which takes time proportional to the square of the
+        number of components.
         """
         if not components:
             components = self.components
@@ -643,6 +912,19 @@ class netlist():
         for c in components:
             c.grouped = False
 
+        # Group components by key, keeping the groups in order of their first
+        # component as the comparison below does
+        if key:
+            keyGroups = {}
+            for c in components:
+                k = key(c)
+                group = keyGroups.get(k)
+                if group is None:
+                    group = keyGroups[k] = []
+                    groups.append(group)
+                group.append(c)
+                c.grouped = True
+
         # Group components based on the value, library and part identifiers
         for c in components:
             if c.grouped == False:
@@ -738,6 +1020,86 @@ class netlist():
             print( __file__, ":", e, file=sys.stderr )
             sys.exit(-1)
 
+    # The elements below the root of a generic netlist
+    _sections = ("design", "components", "libparts", "libraries", "nets")
+
+    def loadFast(self, fname, skipNets=False):
+        """Load a kicad generic netlist using ElementTree.iterparse, which
+        parses in C, and build the same tree as load() one section at a time.
+        Only the sections KiCad writes below the root element are read.
+
+        Keywords:
+        fname -- The name of the generic netlist file to open
+        skipNets -- If True, stop reading at the first net, leaving self.nets
+                    and self.netIndex empty.  KiCad writes the nets last, so the rest of the
+                    file is not read at all, and the attributes of the root
+                    element are not read either.
+
+        """
+        self.tree = xmlElement("export")
+        elem = None
+
+        # Every element refers to its parent, so the cyclic garbage collector
+        # would scan the growing tree again and again while it is built
+        gcWasEnabled = gc.isenabled()
+        gc.disable()
+        try:
+            for event, elem in ElementTree.iterparse(fname):
+                if elem.tag in self._sections:
+                    self.addSection(_fromElementTree(elem, self.tree))
+                    elem.clear()
+                elif skipNets and elem.tag in ("net", "node"):
+                    break
+            else:
+                # The root element ends last
+                if elem is not None:
+                    self.tree.name = elem.tag
+                    for name, value in elem.attrib.items():
+                        self.tree.addAttribute(name, value)
+        except IOError as e:
+            print( __file__, ":", e, file=sys.stderr )
+            sys.exit(-1)
+        finally:
+            if gcWasEnabled:
+                gc.enable()
+
+        self.tree.indexChildren()
+        self.endDocument()
+
+    def addSection(self, section):
+        """Add a complete section xmlElement to the root of the tree"""
+        self.tree.addChild(section)
+        for element in section.iterElements():
+            self.registerElement(element)
+            if element.name == "libpart":
+                self.indexLibPart(self.libparts[-1])
+            if element.name == "net":
+                self.netIndex.addNetElement(element)
+
+
+
+def _fromElementTree(elem, parent=None):
+    """Return the xmlElement tree _gNetReader builds for an ElementTree
+    element and everything below it
+    """
+    element = xmlElement(elem.tag, parent)
+    for name, value in elem.attrib.items():
+        element.addAttribute(name, value)
+
+    # Like _gNetReader.characters(), only keep text which is not all white
+    # space
+    chars = ""
+    if elem.text and not elem.text.isspace():
+        chars = elem.text
+    for child in elem:
+        element.children.append(_fromElementTree(child, element))
+        if child.tail and not child.tail.isspace():
+            chars += child.tail
+    element.chars = chars
+
+    if element.children:
+        element.indexChildren()
+    return element
 
 
 class _gNetReader(sax.handler.ContentHandler):
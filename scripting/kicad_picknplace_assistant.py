@@ -309,7 +309,7 @@ def process(pcbfile, side=pcbnew.F_Cu, netlist=None, output=None):
 
     # load netlist
     if netlist is not None:
-        net = kicad_netlist_reader.netlist(netlist)
+        net = kicad_netlist_reader.netlist(netlist, fast=True, skipNets=True)
         refs = [x.getRef() for x in net.getInterestingComponents()]
 
     # build BOM
@@ -0,0 +1,245 @@
+import gc
+
+import pytest
+
+import kicad_netlist_reader
+
+TEST_NETLIST = """\
+<?xml version="1.0" encoding="UTF-8"?>
+<export version="D">
+  <design>
+    <source>/tmp/board.sch</source>
+    <date>Mon 01 Jan 2018</date>
+    <tool>Eeschema 4.0.7</tool>
+    <sheet number="1" name="/" tstamps="/">
+      <title_block>
+        <title>Power &amp; Logic</title>
+      </title_block>
+    </sheet>
+  </design>
+  <components>
+    <comp ref="R1">
+      <value>4.7k &amp; "x"</value>
+      <footprint>fp:R_0402</footprint>
+      <fields>
+        <field name="MPN">RC0402 &lt;1%&gt;</field>
+        <field name="DNP">DNP</field>
+      </fields>
+      <libsource lib="device" part="R" description="Resistor"/>
+      <sheetpath names="/" tstamps="/"/>
+      <tstamp>5A000001</tstamp>
+    </comp>
+    <comp ref="R2">
+      <value>10k</value>
+      <libsource lib="device" part="R_US" description="Resistor"/>
+      <sheetpath names="/" tstamps="/"/>
+      <tstamp>5A000002</tstamp>
+    </comp>
+    <comp ref="D1">
+      <value>RED</value>
+      <libsource lib="device" part="LED_SMALL" description="LED"/>
+      <sheetpath names="/" tstamps="/"/>
+      <tstamp>5A000003</tstamp>
+    </comp>
+    <comp ref="TP1">
+      <value>TP</value>
+      <footprint>fp:TP</footprint>
+      <libsource lib="nolib" part="MISSING" description="Test point"/>
+      <sheetpath names="/" tstamps="/"/>
+      <tstamp>5A000004</tstamp>
+    </comp>
+  </components>
+  <libparts>
+    <libpart lib="device" part="R">
+      <aliases>
+        <alias>R_US</alias>
+      </aliases>
+      <description>Resistor</description>
+      <fields>
+        <field name="Reference">R</field>
+        <field name="Value">R</field>
+        <field name="Footprint">libfp:R</field>
+        <field name="Vendor">Yageo &amp; Co</field>
+      </fields>
+      <pins>
+        <pin num="1" name="~" type="passive"/>
+        <pin num="2" name="~" type="passive"/>
+      </pins>
+    </libpart>
+    <libpart lib="device" part="LED">
+      <aliases>
+        <alias>LED_ALT</alias>
+        <alias>LED_SMALL</alias>
+      </aliases>
+      <fields>
+        <field name="Reference">D</field>
+        <field name="Value">LED</field>
+      </fields>
+      <pins>
+        <pin num="1" name="K" type="passive"/>
+        <pin num="2" name="A" type="passive"/>
+      </pins>
+    </libpart>
+  </libparts>
+  <libraries>
+    <library logical="device">
+      <uri>/lib/device.lib</uri>
+    </library>
+  </libraries>
+  <nets>
+    <net code="1" name="GND">
+      <node ref="R1" pin="2"/>
+      <node ref="D1" pin="1"/>
+    </net>
+    <net code="2" name="/LED">
+      <node ref="R1" pin="1"/>
+      <node ref="D1" pin="2"/>
+      <node ref="R2" pin="2"/>
+    </net>
+    <net code="3" name="Net-(R2-Pad1)">
+      <node ref="R2" pin="1"/>
+    </net>
+  </nets>
+</export>
+"""
+
+
+@pytest.fixture
+def netlist_file(tmp_path):
+    filename = tmp_path / 'test.xml'
+    filename.write_text(TEST_NETLIST, encoding='utf-8')
+    return str(filename)
+
+
+def describe(net):
+    """Everything the BOM scripts read from a netlist"""
+    ret = [net.getDate(), net.getSource(), net.getTool(),
+           len(net.libparts), len(net.libraries)]
+    for c in net.components:
+        libpart = c.getLibPart()
+        ret.append((c.getRef(), c.getValue(), c.getFootprint(),
+                    c.getDatasheet(), c.getField('MPN'), c.getField('Vendor'),
+                    c.getFieldNames(), c.getDescription(), c.getTimestamp(),
+                    c.getLibName(), c.getPartName(),
+                    libpart and libpart.getPartName()))
+    for p in net.libparts:
+        ret.append((p.getLibName(), p.getPartName(), p.getAliases(),
+                    p.getFieldNames(), p.getField('Vendor')))
+    groups = net.groupComponents(
+        net.components, key=lambda c: (c.getValue(), c.getPartName()))
+    ret.append([[c.getRef() for c in g] for g in groups])
+    return ret
+
+
+def test_load(netlist_file):
+    net = kicad_netlist_reader.netlist(netlist_file)
+    r1, r2, d1, tp1 = net.components
+
+    assert r1.getValue() == '4.7k & "x"'
+    assert r1.getField('MPN') == 'RC0402 <1%>'
+    assert r1.getField('Vendor') == 'Yageo & Co'
+    assert r1.getFootprint() == 'fp:R_0402'
+    assert r2.getFootprint() == 'libfp:R'
+    # Linked through the aliases of their libparts
+    assert r2.getLibPart() is net.libparts[0]
+    assert d1.getLibPart() is net.libparts[1]
+    assert tp1.getLibPart() is None
+    assert len(net.nets) == 3
+
+
+def test_load_fast(netlist_file):
+    net = kicad_netlist_reader.netlist(netlist_file)
+    fast = kicad_netlist_reader.netlist(netlist_file, fast=True)
+
+    assert describe(fast) == describe(net)
+    assert fast.formatXML() == net.formatXML()
+    assert [x.formatXML() for x in fast.nets] == \
+        [x.formatXML() for x in net.nets]
+
+
+def test_load_fast_skip_nets(netlist_file):
+    net = kicad_netlist_reader.netlist(netlist_file)
+    fast = kicad_netlist_reader.netlist(netlist_file, fast=True, skipNets=True)
+
+    assert describe(fast) == describe(net)
+    assert fast.nets == []
+    assert fast.tree.getChild('nets') is None
+    assert fast.tree.getChild('libraries') is not None
+
+
+def test_load_fast_restores_gc(netlist_file, tmp_path):
+    # loadFast() pauses the cyclic garbage collector while it builds the
+    # tree, it must leave it as it found it
+    assert gc.isenabled()
+    kicad_netlist_reader.netlist(netlist_file, fast=True)
+    assert gc.isenabled()
+
+    gc.disable()
+    try:
+        kicad_netlist_reader.netlist(netlist_file, fast=True)
+        assert not gc.isenabled()
+    finally:
+        gc.enable()
+
+    broken = tmp_path / 'broken.xml'
+    broken.write_text(TEST_NETLIST[:TEST_NETLIST.index('<libparts>')])
+    with pytest.raises(Exception):
+        kicad_netlist_reader.netlist(str(broken), fast=True)
+    assert gc.isenabled()
+
+
+@pytest.fixture(params=[False, True], ids=['load', 'loadFast'])
+def net_index(request, netlist_file):
+    return kicad_netlist_reader.netlist(netlist_file,
+                                        fast=request.param).netIndex
+
+
+def test_net_index_nets(net_index):
+    assert net_index.getNetNames() == ['GND', '/LED', 'Net-(R2-Pad1)']
+    assert net_index.getNetCode('/LED') == 2
+    assert net_index.getNetName(3) == 'Net-(R2-Pad1)'
+    assert net_index.getNetCode('VCC') is None
+    assert net_index.getNetName(4) is None
+
+    assert net_index.getNetNodes('/LED') == [('R1', '1'), ('D1', '2'),
+                                             ('R2', '2')]
+    assert net_index.getNetNodesByCode(1) == [('R1', '2'), ('D1', '1')]
+    assert net_index.getNetNodes('VCC') == []
+    assert net_index.getNetNodesByCode(4) == []
+    assert net_index.getNetRefs('GND') == ['R1', 'D1']
+
+
+def test_net_index_refs(net_index):
+    assert net_index.getRefNets('R1') == [('2', 'GND'), ('1', '/LED')]
+    assert net_index.getRefNets('R2') == [('2', '/LED'),
+                                          ('1', 'Net-(R2-Pad1)')]
+    assert net_index.getPinNet('D1', '2') == '/LED'
+    assert net_index.getPinNet('R2', '1') == 'Net-(R2-Pad1)'
+
+    # Unknown pins, and a component on no net at all
+    assert net_index.getPinNet('D1', '3') is None
+    assert net_index.getPinNet('R1', 'A') is None
+    assert net_index.getRefNets('TP1') == []
+    assert net_index.getPinNet('TP1', '1') is None
+    assert net_index.getRefNets('U1') == []
+
+
+def test_net_index_ref_order():
+    index = kicad_netlist_reader.netIndex()
+    index.addNet(10, 'A', [('U1', '1'), ('R1', '1'), ('U1', '2')])
+    index.addNet(11, 'B', [('C1', '1'), ('U1', '3')])
+    assert index.getRefNets('U1') == [('1', 'A'), ('2', 'A'), ('3', 'B')]
+    assert index.getRefNets('C1') == [('1', 'B')]
+
+    # Adding a net after a lookup rebuilds the per-ref index
+    index.addNet(12, 'A', [('R1', '2'), ('U1', '4')])
+    assert index.getRefNets('U1') == [('1', 'A'), ('2', 'A'), ('3', 'B'),
+                                      ('4', 'A')]
+    assert index.getRefNets('R1') == [('1', 'A'), ('2', 'A')]
+    assert index.getPinNet('U1', '4') == 'A'
+
+    # A repeated name keeps pointing at the first net
+    assert index.getNetCode('A') == 10
+    assert index.getNetName(12) == 'A'
+    assert index.getNetNodes('A') == [('U1', '1'), ('R1', '1'), ('U1', '2')]
+    assert index.getNetNodesByCode(12) == [('R1', '2'), ('U1', '4')]
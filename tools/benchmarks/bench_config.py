@@ -0,0 +1,81 @@
+"""Compare resolving parameterize.json for every cell of every row with the
+precompiled column plan used by parametrize, over the tables in tables/"""
+__author__ = 'MegabytePhreak'
+
+from argparse import ArgumentParser
+import csv
+from glob import glob
+from os import path
+import sys
+import timeit
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..'))
+
+from parametrize import compile_config, load_config
+
+ROOT = path.join(path.dirname(path.abspath(__file__)), '..', '..')
+
+
+def resolve_per_cell(config, rows):
+    """Field resolution as parametrize did it before compile_config()"""
+    for row in rows:
+        fields = {}
+        for key, value in row.items():
+            if key in config['ignore_fields']:
+                continue
+            if key in config['translate_fields']:
+                key = config['translate_fields'][key]
+            if value == '' or value is None:
+                value = '~'
+            elif key in config['prepend_fields']:
+                value = config['prepend_fields'][key] + value
+            fields[key] = (value, True if key in config['visible_fields'] else None)
+
+
+def resolve_with_plan(config, fieldnames, rows):
+    plan = compile_config(config, fieldnames)
+    for row in rows:
+        fields = {}
+        for column, key, prefix, visible in plan:
+            value = row[column]
+            if value == '' or value is None:
+                value = '~'
+            elif prefix is not None:
+                value = prefix + value
+            fields[key] = (value, visible)
+
+
+def bench_config(args = None):
+    parser = ArgumentParser(description='Benchmark per-table config resolution')
+    parser.add_argument('tables', type=str, nargs='*',
+                        default=sorted(glob(path.join(ROOT, 'tables', '*.csv'))),
+                        help='CSV tables to resolve')
+    parser.add_argument('-c', '--config', type=str,
+                        default=path.join(ROOT, 'parameterize.json'),
+                        help='Configuration File')
+    parser.add_argument('-n', '--number', type=int, default=200,
+                        help='Number of passes over each table')
+
+    args = parser.parse_args(args)
+
+    for table in args.tables:
+        name = path.splitext(path.basename(table))[0]
+        with open(args.config, 'r') as f:
+            config = load_config(f, name)
+        with open(table, 'r') as f:
+            reader = csv.DictReader(f)
+            rows = list(reader)
+            fieldnames = reader.fieldnames or []
+
+        per_cell = timeit.timeit(lambda: resolve_per_cell(config, rows),
+                                 number=args.number) / args.number
+        planned = timeit.timeit(
+            lambda: resolve_with_plan(config, fieldnames, rows),
+            number=args.number) / args.number
+        print('%-12s %5d rows  per cell %8.3f ms  plan %8.3f ms  %5.1fx' % (
+            name, len(rows), per_cell * 1000, planned * 1000,
+            per_cell / planned if planned else 0))
+
+
+if __name__ == '__main__':
+    bench_config()
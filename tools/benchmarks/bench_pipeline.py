@@ -0,0 +1,218 @@
+"""Time each stage of the library generation pipeline over synthesized
+libraries and tables, using symbols/base-symbols.lib as a template.
+
+Results can be saved as JSON and compared against a previous run, in which
+case the exit status is non-zero if any stage got slower than the allowed
+tolerance."""
+__author__ = 'MegabytePhreak'
+
+from argparse import ArgumentParser
+from copy import deepcopy
+import csv
+from io import StringIO
+import itertools
+import json
+from os import path
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..'))
+
+from kicad_parsers.symbols import LazyLibrary, load_lib, tokenize
+from parametrize import compile_config, load_config, open_rows, parametrize_table, render_symbol
+
+ROOT = path.join(path.dirname(path.abspath(__file__)), '..', '..')
+BASE_LIBRARY = path.join(ROOT, 'symbols', 'base-symbols.lib')
+CONFIG = path.join(ROOT, 'parameterize.json')
+
+COLUMNS = ['PARTNUMBER', 'SYMBOL', 'FOOTPRINT', 'VALUE', 'VOLTAGE',
+           'TOLERANCE', 'PACKAGE', 'MANUFACTURER', 'MANUFACTURER_PART_NUMBER',
+           'DESCRIPTION', 'ComponentLink1URL', 'Supplier 1',
+           'Supplier Part Number 1', 'Supplier 2', 'Supplier Part Number 2']
+
+
+def synthesize_library(symbols, count):
+    """Return the text of a library with count symbols, cycling through the
+    template symbols under new names"""
+    lines = ['EESchema-LIBRARY Version 2.4', '#encoding utf-8']
+    for i in range(count):
+        symbol = symbols[i % len(symbols)].derive()
+        symbol.set_name('%s_%d' % (symbol.get_field('Name'), i))
+        lines.append('#')
+        lines.append(symbol.serialize())
+    lines.append('#')
+    lines.append('#End Library')
+    return '\n'.join(lines) + '\n'
+
+
+def synthesize_table(symbol_names, count, seed=0):
+    """Return the text of a CSV table with count rows in random order"""
+    rng = random.Random(seed)
+    output = StringIO()
+    writer = csv.writer(output)
+    writer.writerow(COLUMNS)
+    for i in rng.sample(range(count), count):
+        writer.writerow([
+            'P%06d' % i, rng.choice(symbol_names), 'R_0402_1005M',
+            '%dk' % rng.randint(1, 999), '50V', '1%', '0402', 'Yageo',
+            'RC0402FR-07%dKL' % i, 'RES %d OHM 0402 "SMD"' % i,
+            'http://example.com/%d.pdf' % i, 'Digi-Key', '%d-ND' % i,
+            '' if i % 3 else 'Mouser', '' if i % 3 else '%d-MOU' % i,
+        ])
+    return output.getvalue()
+
+
+class Stages:
+    """Runs and records the timing and peak memory of each stage.
+
+    A stage is func(inputs), where inputs is built by setup() before the
+    stage is timed. The memory pass builds a new set of inputs, so it
+    repeats the work of the timed run rather than running on state the
+    timed run left behind."""
+    def __init__(self, measure_memory):
+        self.measure_memory = measure_memory
+        self.results = {}
+
+    def run(self, name, func, setup=lambda: None):
+        inputs = setup()
+        start = time.perf_counter()
+        result = func(inputs)
+        elapsed = time.perf_counter() - start
+
+        peak = None
+        if self.measure_memory:
+            inputs = setup()
+            tracemalloc.start()
+            func(inputs)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        self.results[name] = {'seconds': elapsed, 'peak_bytes': peak}
+        return result
+
+
+def bench_size(count, template, measure_memory, workdir):
+    stages = Stages(measure_memory)
+    symbol_names = [x.get_field('Name') for x in template]
+
+    lib_text = synthesize_library(template, count)
+    lib_name = path.join(workdir, 'bench-%d.lib' % count)
+    with open(lib_name, 'w') as f:
+        f.write(lib_text)
+    csv_name = path.join(workdir, 'bench-%d.csv' % count)
+    with open(csv_name, 'w') as f:
+        f.write(synthesize_table(symbol_names, count))
+
+    def symbols():
+        return load_lib(StringIO(lib_text))
+
+    def derived():
+        return [x.derive() for x in symbols()]
+
+    def with_fields():
+        result = derived()
+        for i, x in enumerate(result):
+            x.set_or_add_field('Field %d' % (i % 8), str(i))
+        return result
+
+    stages.run('load_lib', lambda _: load_lib(StringIO(lib_text)))
+    stages.run('lazy_index', lambda _: LazyLibrary(lib_name))
+    lines = lib_text.split('\n')
+    stages.run('tokenize', lambda _: [tokenize(x) for x in lines])
+    stages.run('get_field', lambda x: [y.get_field('Name') for y in x], symbols)
+    stages.run('deepcopy', lambda x: [deepcopy(y) for y in x], symbols)
+    stages.run('derive', lambda x: [y.derive() for y in x], symbols)
+    stages.run('set_or_add_field', lambda x: [
+        y.set_or_add_field('Field %d' % (i % 8), str(i))
+        for i, y in enumerate(x)], derived)
+    stages.run('serialize', lambda x: [y.serialize() for y in x], with_fields)
+
+    with open(CONFIG, 'r') as f:
+        config = load_config(f, 'bench')
+
+    def symbol_lib():
+        return {x.get_field('Name'): x for x in deepcopy(template)}
+
+    def render(lib):
+        with open_rows(csv_name) as (fieldnames, rows):
+            plan = compile_config(config, fieldnames)
+            return [render_symbol(lib, plan, row) for row in rows]
+    stages.run('render_rows', render, symbol_lib)
+
+    runs = itertools.count()
+
+    def generate_setup():
+        # Each run writes new files rather than overwriting the last ones
+        return symbol_lib(), path.join(workdir, 'out-%d-%d' % (count, next(runs)))
+
+    def generate(inputs):
+        lib, output_name = inputs
+        with open_rows(csv_name, stream=True) as (fieldnames, rows):
+            parametrize_table(lib, config, fieldnames, rows, output_name,
+                              stream=True)
+    stages.run('parametrize_table', generate, generate_setup)
+
+    return stages.results
+
+
+def compare(results, baseline, tolerance):
+    """Print stages slower than the baseline, returning True if none are"""
+    ok = True
+    for size, stages in results.items():
+        for name, result in stages.items():
+            base = baseline.get(size, {}).get(name)
+            if base is None or not base['seconds']:
+                continue
+            ratio = result['seconds'] / base['seconds']
+            if ratio > 1 + tolerance:
+                ok = False
+                print('REGRESSION %8s rows %-18s %.2fx slower' % (size, name, ratio))
+    return ok
+
+
+def bench_pipeline(args = None):
+    parser = ArgumentParser(description='Benchmark the library generation pipeline')
+    parser.add_argument('-s', '--sizes', type=int, nargs='+',
+                        default=[1000, 10000, 100000],
+                        help='Number of symbols and rows to synthesize')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='Skip the peak memory measurement, which reruns every stage')
+    parser.add_argument('--save', type=str, default=None,
+                        help='Write the results to a JSON file')
+    parser.add_argument('--compare', type=str, default=None,
+                        help='Compare against results saved by a previous run')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Allowed slowdown when comparing, as a fraction')
+
+    args = parser.parse_args(args)
+
+    with open(BASE_LIBRARY, 'r') as f:
+        template = load_lib(f)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for count in args.sizes:
+            results[str(count)] = bench_size(count, template,
+                                             not args.no_memory, workdir)
+            for name, result in results[str(count)].items():
+                peak = result['peak_bytes']
+                print('%8d rows %-18s %10.2f ms %12s' % (
+                    count, name, result['seconds'] * 1000,
+                    '%.1f MiB' % (peak / 2**20) if peak is not None else ''))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1)
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        if not compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    bench_pipeline()
@@ -0,0 +1,47 @@
+"""Compare tokenize() with the reference character loop tokenizer over the
+lines of the repository's symbol libraries"""
+__author__ = 'MegabytePhreak'
+
+from argparse import ArgumentParser
+from os import path
+import sys
+import timeit
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..'))
+
+from kicad_parsers.symbols import tokenize, _tokenize_loop
+
+ROOT = path.join(path.dirname(path.abspath(__file__)), '..', '..')
+LIBRARIES = [
+    path.join(ROOT, 'symbols', 'power.lib'),
+    path.join(ROOT, 'symbols', 'base-symbols.lib'),
+]
+
+
+def bench_tokenize(args = None):
+    parser = ArgumentParser(description='Benchmark the symbol line tokenizers')
+    parser.add_argument('libraries', type=str, nargs='*', default=LIBRARIES,
+                        help='Libraries to tokenize')
+    parser.add_argument('-n', '--number', type=int, default=20,
+                        help='Number of passes over each library')
+
+    args = parser.parse_args(args)
+
+    for library in args.libraries:
+        with open(library, 'r') as f:
+            lines = [x.strip() for x in f]
+
+        results = []
+        for func in (_tokenize_loop, tokenize):
+            elapsed = timeit.timeit(lambda: [func(x) for x in lines],
+                                    number=args.number)
+            results.append(elapsed)
+            print('%-20s %-16s %8.2f ms/pass' % (
+                path.basename(library), func.__name__,
+                elapsed * 1000 / args.number))
+        print('%-20s %-16s %8.1fx' % (path.basename(library), 'speedup',
+                                      results[0] / results[1]))
+
+
+if __name__ == '__main__':
+    bench_tokenize()
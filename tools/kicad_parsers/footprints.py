@@ -0,0 +1,309 @@
+__author__ = 'MegabytePhreak'
+
+import json
+import marshal
+import os
+from os import path
+import re
+
+from kicad_parsers.symbols import ParseError
+
+FOOTPRINT_EXT = '.kicad_mod'
+
+
+def library_nickname(directory):
+    """Return the nickname KiCad gives a .pretty footprint library"""
+    name = path.basename(path.normpath(directory))
+    return name[:-len('.pretty')] if name.endswith('.pretty') else name
+
+
+class FootprintIndex:
+    """The set of footprint names in a .pretty footprint library.
+
+    If cache_file is given the names are saved there along with the
+    directory's modification time, and reused until the directory changes."""
+    def __init__(self, directory, cache_file=None):
+        self.directory = directory
+        self.nickname = library_nickname(directory)
+        mtime = os.stat(directory).st_mtime_ns
+
+        names = self._read_cache(cache_file, mtime) if cache_file else None
+        if names is None:
+            names = [x.name[:-len(FOOTPRINT_EXT)]
+                     for x in os.scandir(directory)
+                     if x.name.endswith(FOOTPRINT_EXT)]
+            if cache_file:
+                self._write_cache(cache_file, mtime, names)
+        self.names = frozenset(names)
+
+    def _read_cache(self, cache_file, mtime):
+        try:
+            with open(cache_file, 'r') as f:
+                cache = json.load(f)
+            if cache['directory'] == path.abspath(self.directory) and \
+                    cache['mtime'] == mtime:
+                return cache['names']
+        except (OSError, ValueError, KeyError):
+            pass
+        return None
+
+    def _write_cache(self, cache_file, mtime, names):
+        try:
+            directory = path.dirname(cache_file)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(cache_file, 'w') as f:
+                json.dump({'directory': path.abspath(self.directory),
+                           'mtime': mtime, 'names': sorted(names)}, f)
+        except OSError:
+            pass
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def __len__(self):
+        return len(self.names)
+
+    def check(self, reference):
+        """Check a 'nickname:name' footprint reference.
+
+        Returns False only if the reference is to this library and the
+        footprint is missing from it. References to other libraries and
+        empty references are not checked."""
+        nickname, sep, name = reference.partition(':')
+        if not sep or nickname != self.nickname:
+            return True
+        return name in self.names
+
+
+_SEXPR_TOKEN_RE = re.compile(r'[()]|"(?:[^"\\]|\\.)*"|[^\s()"]+', re.DOTALL)
+_SEXPR_ESCAPE_RE = re.compile(r'\\(.)', re.DOTALL)
+
+
+def iter_sexpr_tokens(text):
+    """Yield the parentheses and atoms of an s-expression one at a time.
+
+    Quoted atoms are unquoted; all atoms are returned as strings."""
+    for match in _SEXPR_TOKEN_RE.finditer(text):
+        token = match.group()
+        if token[0] == '"':
+            token = token[1:-1]
+            if '\\' in token:
+                token = _SEXPR_ESCAPE_RE.sub(r'\1', token)
+        yield token
+
+
+def parse_sexpr(text, filename='<string>'):
+    """Parse a single s-expression into nested lists of strings"""
+    stack = []
+    current = None
+    result = None
+    for token in iter_sexpr_tokens(text):
+        if token == '(':
+            if result is not None:
+                raise ParseError('%s: Data after the end of the expression', filename)
+            stack.append(current)
+            current = []
+        elif token == ')':
+            if not stack:
+                raise ParseError('%s: Unbalanced ")"', filename)
+            finished = current
+            current = stack.pop()
+            if current is None:
+                result = finished
+            else:
+                current.append(finished)
+        elif current is None:
+            raise ParseError('%s: Atom %r outside of an expression', filename, token)
+        else:
+            current.append(token)
+    if stack:
+        raise ParseError('%s: Unterminated expression', filename)
+    if result is None:
+        raise ParseError('%s: No expression found', filename)
+    return result
+
+
+def _child(node, key):
+    """Return the first child list of node starting with key, or None"""
+    for item in node:
+        if type(item) is list and item and item[0] == key:
+            return item
+    return None
+
+
+def _floats(node, key):
+    child = _child(node, key)
+    return tuple(float(x) for x in child[1:]) if child else None
+
+
+def _numbers(node):
+    """Return the numeric atoms of a list, skipping keywords and sublists"""
+    numbers = []
+    for item in node[1:]:
+        if type(item) is str:
+            try:
+                numbers.append(float(item))
+            except ValueError:
+                pass
+    return numbers
+
+
+class Pad:
+    """A footprint pad. Positions and sizes are in mm.
+
+    drill is the (width, height) of the hole, equal for round holes, or None
+    for pads without one. drill_offset is the (x, y) offset of the pad from
+    the hole, or None."""
+    __slots__ = ('number', 'type', 'shape', 'at', 'size', 'drill',
+                 'drill_shape', 'drill_offset', 'layers')
+
+    def __init__(self, node):
+        self.number = node[1]
+        self.type = node[2]
+        self.shape = node[3]
+        at = _floats(node, 'at')
+        self.at = at + (0.0,) * (3 - len(at))
+        self.size = _floats(node, 'size')
+
+        # (drill [oval] width [height] [(offset x y)])
+        self.drill = None
+        self.drill_shape = None
+        self.drill_offset = None
+        drill = _child(node, 'drill')
+        if drill:
+            numbers = _numbers(drill)
+            if numbers:
+                self.drill_shape = 'oval' if 'oval' in drill else 'circle'
+                self.drill = (numbers[0], numbers[1] if len(numbers) > 1
+                              else numbers[0])
+            self.drill_offset = _floats(drill, 'offset')
+
+        layers = _child(node, 'layers')
+        self.layers = tuple(layers[1:]) if layers else ()
+
+
+# Graphic items which can make up a courtyard, and the names of the points
+# which define them
+_COURTYARD_SHAPES = {
+    'fp_line': ('line', ('start', 'end')),
+    'fp_rect': ('rect', ('start', 'end')),
+    'fp_circle': ('circle', ('center', 'end')),
+}
+
+
+def _points(node):
+    """Return the (x, y) points of a (pts (xy x y) ...) list"""
+    pts = _child(node, 'pts')
+    if not pts:
+        return ()
+    return tuple(tuple(float(x) for x in xy[1:3]) for xy in pts[1:]
+                 if type(xy) is list and xy and xy[0] == 'xy')
+
+
+class Footprint:
+    """The contents of a .kicad_mod file.
+
+    The parsed expression is kept in tree; the pads and courtyard outline
+    are extracted from it when the footprint is created. The courtyard is a
+    list of (kind, points) shapes: ('line', (start, end)), ('rect', (start,
+    end)), ('circle', (center, point on the circle)) or ('poly', points)."""
+    def __init__(self, tree):
+        if not tree or tree[0] not in ('module', 'footprint'):
+            raise ParseError('Not a footprint: %r', tree[:1])
+        self.tree = tree
+        self.name = tree[1]
+        layer = _child(tree, 'layer')
+        self.layer = layer[1] if layer else None
+        self.pads = [Pad(x) for x in tree
+                     if type(x) is list and x and x[0] == 'pad']
+        self.courtyard = []
+        for item in tree:
+            if type(item) is not list or not item:
+                continue
+            if item[0] in _COURTYARD_SHAPES or item[0] == 'fp_poly':
+                layer = _child(item, 'layer')
+                if not layer or not layer[1].endswith('.CrtYd'):
+                    continue
+                if item[0] == 'fp_poly':
+                    self.courtyard.append(('poly', _points(item)))
+                else:
+                    kind, names = _COURTYARD_SHAPES[item[0]]
+                    self.courtyard.append(
+                        (kind, tuple(_floats(item, x) for x in names)))
+
+    def pad_numbers(self):
+        """Return the set of distinct, non-empty pad numbers"""
+        return {x.number for x in self.pads if x.number}
+
+    def courtyard_bounds(self):
+        """Return (min x, min y, max x, max y) of the courtyard, or None if
+        the footprint has no courtyard"""
+        xs = []
+        ys = []
+        for kind, points in self.courtyard:
+            if kind == 'circle':
+                (cx, cy), (x, y) = points
+                radius = ((x - cx) ** 2 + (y - cy) ** 2) ** 0.5
+                xs.extend((cx - radius, cx + radius))
+                ys.extend((cy - radius, cy + radius))
+            else:
+                xs.extend(p[0] for p in points)
+                ys.extend(p[1] for p in points)
+        if not xs:
+            return None
+        return min(xs), min(ys), max(xs), max(ys)
+
+
+def load_footprint(filename):
+    """Load a single .kicad_mod file"""
+    with open(filename, 'r') as f:
+        return Footprint(parse_sexpr(f.read(), filename))
+
+
+_CACHE_VERSION = 1
+
+
+def load_footprint_library(directory, cache_file=None):
+    """Load every footprint in a .pretty directory, returning a dict of
+    name to Footprint.
+
+    If cache_file is given the parsed expressions are saved there with
+    marshal, and a footprint is only parsed again if its file's size or
+    modification time changed."""
+    cached = {}
+    if cache_file:
+        try:
+            with open(cache_file, 'rb') as f:
+                version, cached = marshal.loads(f.read())
+            if version != _CACHE_VERSION:
+                cached = {}
+        except (OSError, EOFError, ValueError, TypeError):
+            cached = {}
+
+    entries = {}
+    footprints = {}
+    for entry in os.scandir(directory):
+        if not entry.name.endswith(FOOTPRINT_EXT):
+            continue
+        stat = entry.stat()
+        key = (stat.st_mtime_ns, stat.st_size)
+        hit = cached.get(entry.name)
+        if hit is not None and tuple(hit[0]) == key:
+            tree = hit[1]
+        else:
+            with open(entry.path, 'r') as f:
+                tree = parse_sexpr(f.read(), entry.path)
+        entries[entry.name] = (key, tree)
+        footprints[entry.name[:-len(FOOTPRINT_EXT)]] = Footprint(tree)
+
+    if cache_file and entries != cached:
+        try:
+            cache_dir = path.dirname(cache_file)
+            if cache_dir:
+                os.makedirs(cache_dir, exist_ok=True)
+            with open(cache_file, 'wb') as f:
+                f.write(marshal.dumps((_CACHE_VERSION, entries)))
+        except OSError:
+            pass
+    return footprints
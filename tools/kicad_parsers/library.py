@@ -0,0 +1,196 @@
+__author__ = 'MegabytePhreak'
+
+from collections.abc import Mapping
+from os import path
+import re
+
+from kicad_parsers.symbols import LazyLibrary, MappedFile
+
+LIB_HEADER = 'EESchema-LIBRARY Version 2.4\n'
+LIB_FOOTER = '#\n#End Library\n'
+DCM_HEADER = 'EESchema-DOCLIB  Version 2.0\n'
+DCM_FOOTER = '#\n#End Doc Library\n'
+
+
+class DocEntry:
+    """The documentation of one symbol in a .dcm file.
+
+    Lines other than the description (D), keywords (K) and datasheet (F)
+    are kept in extra. The order the lines were read in is remembered, so
+    parsed entries are written back unchanged."""
+    __slots__ = ('name', 'description', 'keywords', 'datasheet', 'extra',
+                 '_order')
+
+    _KEYS = (('D', 'description'), ('K', 'keywords'), ('F', 'datasheet'))
+
+    def __init__(self, name, description=None, keywords=None, datasheet=None,
+                 extra=()):
+        self.name = name
+        self.description = description
+        self.keywords = keywords
+        self.datasheet = datasheet
+        self.extra = extra
+        # The D/K/F keys and indexes into extra in the order read, or None
+        self._order = None
+
+    @staticmethod
+    def parse(lines):
+        """Parse the lines from $CMP to $ENDCMP of an entry"""
+        entry = DocEntry(lines[0][len('$CMP '):].strip())
+        extra = []
+        order = []
+        for line in lines[1:-1]:
+            for key, attribute in DocEntry._KEYS:
+                if line.startswith(key + ' '):
+                    setattr(entry, attribute, line[2:])
+                    order.append(key)
+                    break
+            else:
+                order.append(len(extra))
+                extra.append(line)
+        entry.extra = tuple(extra)
+        entry._order = tuple(order)
+        return entry
+
+    def serialize(self):
+        order = self._order
+        if order is None:
+            order = [key for key, _ in self._KEYS] + list(range(len(self.extra)))
+
+        lines = ['$CMP %s' % self.name]
+        # Keys set since parsing go first, where they would be in a new entry
+        for key, attribute in self._KEYS:
+            value = getattr(self, attribute)
+            if value is not None and key not in order:
+                lines.append('%s %s' % (key, value))
+        for item in order:
+            if isinstance(item, int):
+                lines.append(self.extra[item])
+            else:
+                value = getattr(self, dict(self._KEYS)[item])
+                if value is not None:
+                    lines.append('%s %s' % (item, value))
+        lines.append('$ENDCMP')
+        return '\n'.join(lines) + '\n'
+
+
+_CMP_RE = re.compile(rb'^\$(?:CMP |ENDCMP)', re.MULTILINE)
+
+
+class LazyDocLibrary(Mapping, MappedFile):
+    """Read-only mapping of symbol name to DocEntry for a .dcm file, indexed
+    when opened and parsed on first access like LazyLibrary"""
+    def __init__(self, filename):
+        self.filename = filename
+        self._entries = {}
+        self._open()
+        self._index = self._index_blocks(_CMP_RE, b'$CMP ', self._entry_name)
+
+    def _entry_name(self, start, end):
+        line_end = self._map.find(b'\n', start, end)
+        return self._map[start + len(b'$CMP '):line_end].decode('utf-8').strip()
+
+    def __getitem__(self, name):
+        entry = self._entries.get(name)
+        if entry is None:
+            start, end = self._index[name]
+            text = self._map[start:end].decode('utf-8')
+            entry = DocEntry.parse([x.strip() for x in text.splitlines()])
+            self._entries[name] = entry
+        return entry
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+
+class LibraryWriter:
+    """Writes a .lib and its .dcm together, one symbol at a time"""
+    def __init__(self, lib_output, dcm_output):
+        self.lib_output = lib_output
+        self.dcm_output = dcm_output
+        lib_output.write(LIB_HEADER)
+        dcm_output.write(DCM_HEADER)
+
+    def write(self, symbol, doc=None):
+        self.write_text(symbol.serialize() + '\n',
+                        doc.serialize() if doc is not None else '')
+
+    def write_text(self, lib_text, dcm_text):
+        """Write already serialized symbol and doc text"""
+        self.lib_output.write(lib_text)
+        self.dcm_output.write(dcm_text)
+
+    def finish(self):
+        self.lib_output.write(LIB_FOOTER)
+        self.dcm_output.write(DCM_FOOTER)
+
+
+def doc_filename(filename):
+    """Return the name of the .dcm file belonging to a .lib file"""
+    return path.splitext(filename)[0] + '.dcm'
+
+
+class Library:
+    """A .lib file paired with its .dcm file.
+
+    Symbols are loaded lazily as by LazyLibrary. The .dcm file is only
+    opened and indexed the first time a doc entry is requested, and a
+    missing .dcm file is treated as empty."""
+    def __init__(self, filename, dcm_filename=None, sidecar=False):
+        self.filename = filename
+        self.dcm_filename = dcm_filename or doc_filename(filename)
+        self.symbols = LazyLibrary(filename, sidecar=sidecar)
+        self._docs = None
+
+    @property
+    def docs(self):
+        if self._docs is None:
+            if path.exists(self.dcm_filename):
+                self._docs = LazyDocLibrary(self.dcm_filename)
+            else:
+                self._docs = {}
+        return self._docs
+
+    def __getitem__(self, name):
+        return self.symbols[name]
+
+    def __contains__(self, name):
+        return name in self.symbols
+
+    def __iter__(self):
+        return iter(self.symbols)
+
+    def __len__(self):
+        return len(self.symbols)
+
+    def close(self):
+        """Unmap the .lib and .dcm files"""
+        self.symbols.close()
+        if isinstance(self._docs, LazyDocLibrary):
+            self._docs.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def doc(self, name):
+        """Return the DocEntry for a symbol, or None if it has none"""
+        return self.docs.get(name)
+
+    def write(self, filename, dcm_filename=None, names=None):
+        """Write the symbols named in names, or all of them, and their doc
+        entries to a new .lib and .dcm pair in one pass"""
+        with open(filename, 'w') as lib_output, \
+                open(dcm_filename or doc_filename(filename), 'w') as dcm_output:
+            writer = LibraryWriter(lib_output, dcm_output)
+            for name in (names if names is not None else self):
+                writer.write(self[name], self.doc(name))
+            writer.finish()
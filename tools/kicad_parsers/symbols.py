@@ -1,5 +1,10 @@
 __author__ = 'MegabytePhreak'
 
+from collections.abc import Mapping
+from io import StringIO
+from itertools import chain
+import mmap
+import os
 import re
 
 
@@ -11,7 +16,19 @@ class FieldNotFoundException(Exception):
     pass
 
 
+# A token is a run of unquoted characters, escape sequences and quoted strings
+# (which may contain spaces), stopping at the first unquoted space.
+_TOKEN_RE = re.compile(r'(?:[^ "\\]+|\\.?|"(?:[^"\\]+|\\.?)*"?)+', re.DOTALL)
+
+
 def tokenize(line):
+    if '"' not in line and '\\' not in line:
+        return [x for x in line.split(' ') if x]
+    return _TOKEN_RE.findall(line)
+
+
+def _tokenize_loop(line):
+    """Character by character tokenizer, kept as a reference for tokenize()"""
 
     tokens = []
     start = 0
@@ -52,112 +69,347 @@ def quote(s, if_needed=False):
     return s
 
 
-def unquote(s):
+_ESCAPE_RE = re.compile(r'\\(.?)', re.DOTALL)
 
-    if '"' in s:
-        # TODO: simple approach for now. Need to handle escapes
-        s = s.strip('"')
 
-    if s.find('\\'):
-        escaped = False
-        s2 = []
-        for char in s:
-            if escaped:
-                escaped = False
-                s2.append(char)
-            else:
-                if char == '\\':
-                    escaped = True
-                else:
-                    escaped = False
-                    s2.append(char)
-        s = ''.join(s2)
+def unquote(s):
+    # Only quoted strings are escaped, see quote()
+    if not s.startswith('"'):
+        return s
+
+    # Drop the closing quote only if it is not itself escaped, i.e. it is
+    # preceded by an even number of backslashes
+    inner = s[1:-1]
+    if len(s) > 1 and s[-1] == '"' and \
+            (len(inner) - len(inner.rstrip('\\'))) % 2 == 0:
+        s = inner
+    else:
+        s = s[1:]
+
+    if '\\' in s:
+        s = _ESCAPE_RE.sub(r'\1', s)
 
     return s
 
 
+def _join(tokens, extra):
+    """Join tokens, dropping missing (None) ones from the end"""
+    while tokens and tokens[-1] is None:
+        tokens.pop()
+    return " ".join(chain(tokens, extra))
+
+
+class Field:
+    """A parsed F line of a symbol.
+
+    Until the field is modified it serializes to the exact line it was
+    parsed from. Optional trailing tokens that were not present are None."""
+    __slots__ = ('id', 'value', 'x', 'y', 'size', 'orientation', 'visibility',
+                 'hjustify', 'style', 'name', 'extra', '_line')
+
+    def __init__(self, id, value, x='0', y='0', size='50', orientation='H',
+                 visibility='I', hjustify='L', style='CNN', name=None,
+                 extra=(), line=None):
+        self.id = id
+        self.value = value
+        self.x = x
+        self.y = y
+        self.size = size
+        self.orientation = orientation
+        self.visibility = visibility
+        self.hjustify = hjustify
+        self.style = style
+        self.name = name
+        self.extra = extra
+        self._line = line
+
+    @staticmethod
+    def parse(line):
+        tokens = tokenize(line)
+        tokens.extend([None] * (10 - len(tokens)))
+        return Field(int(tokens[0][1:]), unquote(tokens[1]), *tokens[2:9],
+                     name=unquote(tokens[9]) if tokens[9] is not None else None,
+                     extra=tuple(tokens[10:]), line=line)
+
+    def copy(self):
+        return Field(self.id, self.value, self.x, self.y, self.size,
+                     self.orientation, self.visibility, self.hjustify,
+                     self.style, self.name, self.extra, self._line)
+
+    def set_value(self, value):
+        self.value = value
+        self._line = None
+
+    def set_visible(self, visible):
+        self.visibility = 'V' if visible else 'I'
+        self._line = None
+
+    def __str__(self):
+        if self._line is None:
+            self._line = _join([
+                'F%d' % self.id, quote(self.value), self.x, self.y, self.size,
+                self.orientation, self.visibility, self.hjustify, self.style,
+                quote(self.name) if self.name is not None else None
+            ], self.extra)
+        return self._line
+
+
+class SymbolDef:
+    """A parsed DEF line of a symbol, serialized like Field"""
+    __slots__ = ('name', 'reference', 'unused', 'text_offset',
+                 'draw_pinnumber', 'draw_pinname', 'unit_count',
+                 'units_locked', 'option_flag', 'extra', '_line')
+
+    def __init__(self, name, reference, unused=None, text_offset=None,
+                 draw_pinnumber=None, draw_pinname=None, unit_count=None,
+                 units_locked=None, option_flag=None, extra=(), line=None):
+        self.name = name
+        self.reference = reference
+        self.unused = unused
+        self.text_offset = text_offset
+        self.draw_pinnumber = draw_pinnumber
+        self.draw_pinname = draw_pinname
+        self.unit_count = unit_count
+        self.units_locked = units_locked
+        self.option_flag = option_flag
+        self.extra = extra
+        self._line = line
+
+    @staticmethod
+    def parse(line):
+        tokens = tokenize(line)
+        tokens.extend([None] * (10 - len(tokens)))
+        return SymbolDef(unquote(tokens[1]) if tokens[1] is not None else None,
+                         unquote(tokens[2]) if tokens[2] is not None else None,
+                         *tokens[3:10], extra=tuple(tokens[10:]), line=line)
+
+    def copy(self):
+        return SymbolDef(self.name, self.reference, self.unused,
+                         self.text_offset, self.draw_pinnumber,
+                         self.draw_pinname, self.unit_count, self.units_locked,
+                         self.option_flag, self.extra, self._line)
+
+    def set_name(self, name):
+        self.name = name
+        self._line = None
+
+    def set_reference(self, reference):
+        self.reference = reference
+        self._line = None
+
+    def __str__(self):
+        if self._line is None:
+            self._line = _join([
+                'DEF',
+                quote(self.name, if_needed=True),
+                quote(self.reference, if_needed=True),
+                self.unused, self.text_offset, self.draw_pinnumber,
+                self.draw_pinname, self.unit_count, self.units_locked,
+                self.option_flag
+            ], self.extra)
+        return self._line
+
+
+class Pin:
+    """A pin (X line) from the DRAW section of a symbol"""
+    __slots__ = ('name', 'number', 'x', 'y', 'length', 'orientation',
+                 'number_size', 'name_size', 'unit', 'convert',
+                 'electrical_type', 'shape')
+
+    # Electrical type codes used in the legacy library format
+    ELECTRICAL_TYPES = {
+        'I': 'input', 'O': 'output', 'B': 'bidirectional', 'T': 'tristate',
+        'P': 'passive', 'U': 'unspecified', 'W': 'power_in', 'w': 'power_out',
+        'C': 'open_collector', 'E': 'open_emitter', 'N': 'no_connect',
+    }
+
+    def __init__(self, name, number, x, y, length, orientation, number_size,
+                 name_size, unit, convert, electrical_type, shape=None):
+        self.name = name
+        self.number = number
+        self.x = x
+        self.y = y
+        self.length = length
+        self.orientation = orientation
+        self.number_size = number_size
+        self.name_size = name_size
+        self.unit = unit
+        self.convert = convert
+        self.electrical_type = electrical_type
+        self.shape = shape
+
+    @property
+    def electrical_type_name(self):
+        """The name of the electrical type, or None for an unknown code"""
+        return self.ELECTRICAL_TYPES.get(self.electrical_type)
+
+    @staticmethod
+    def parse(line):
+        tokens = tokenize(line)
+        if len(tokens) < 12:
+            raise ParseError("Malformed pin '%s'", line)
+        return Pin(tokens[1], tokens[2], int(tokens[3]), int(tokens[4]),
+                   int(tokens[5]), tokens[6], int(tokens[7]), int(tokens[8]),
+                   int(tokens[9]), int(tokens[10]), tokens[11],
+                   tokens[12] if len(tokens) > 12 else None)
+
+    def __repr__(self):
+        return 'Pin(%r, %r, %d, %d, %r)' % (self.name, self.number, self.x,
+                                            self.y, self.electrical_type)
+
+
 class Symbol:
+    # Fields which KiCad identifies by their id rather than by a name token
+    _FIXED_FIELDS = {'Reference': 0, 'Name': 1, 'Footprint': 2, 'Datasheet': 3}
+
     @staticmethod
     def load_from_string(text):
         return Symbol(text.split('\n'))
 
     def __init__(self, lines):
-        self._lines = lines
-
-    def _find_def(self):
-        for lineno, line in enumerate(self._lines):
-            if line.startswith('DEF '):
-                return lineno
-        raise ParseError("DEF not found in symbol '%s'", self)
-
-    def _find_field_or_last(self, name):
-        last = None
-        for lineno, line in enumerate(self._lines):
+        self._parse_header(lines)
+        self._pins = None
+
+    def _parse_header(self, lines):
+        """Split lines into the owned header of DEF and F records and the
+        shared body, and build the field index for the header"""
+        self._header = []
+        self._def = None
+        self._fields = {}
+        self._last_field = None
+        self._last_id = None
+        for lineno, line in enumerate(lines):
+            if not line:
+                self._header.append(line)
+                continue
+            if self._def is not None and line[0] != 'F':
+                break
             if line[0] == 'F':
-                last = lineno
-                if name == 'Reference':
-                    if line.startswith('F0 '):
-                        break
-                elif name == 'Name':
-                    if line.startswith('F1 '):
-                        break
-                elif name == 'Footprint':
-                    if line.startswith('F2'):
-                        break
-                elif name == 'Datasheet':
-                    if line.startswith('F3'):
-                        break
-                else:
-                    tokens = tokenize(line)
-                    if len(tokens) >= 10:
-                        #print(quote(name), tokens[9])
-                        if tokens[9] == quote(name):
-                            break
+                field = Field.parse(line)
+                self._last_field = len(self._header)
+                self._last_id = field.id
+                self._fields.setdefault(self._field_key_of(field), field)
+                self._header.append(field)
+            elif self._def is None and line.startswith('DEF '):
+                self._def = SymbolDef.parse(line)
+                self._header.append(self._def)
+            else:
+                self._header.append(line)
         else:
-            return (None, last)
-        return (lineno, last)
+            lineno = len(lines)
+
+        # Everything after the DEF and F lines (aliases, footprint filters
+        # and the DRAW section) is never edited, so it is kept as a tuple
+        # that derived symbols can share.
+        self._body = tuple(lines[lineno:])
+
+    @property
+    def _lines(self):
+        return [str(x) for x in self._header]
+
+    def derive(self):
+        """Return a copy of this symbol which owns its own header and fields
+        but shares the body with this symbol"""
+        symbol = Symbol.__new__(Symbol)
+        symbol._body = self._body
+
+        # Only the DEF and indexed fields can be modified, so any other
+        # records are shared like the body
+        symbol._fields = {}
+        copies = {}
+        for key, field in self._fields.items():
+            copies[id(field)] = symbol._fields[key] = field.copy()
+        symbol._def = None
+        if self._def is not None:
+            copies[id(self._def)] = symbol._def = self._def.copy()
+        symbol._header = [copies.get(id(x), x) for x in self._header]
+
+        symbol._last_field = self._last_field
+        symbol._last_id = self._last_id
+        # Pins come from the shared body, so their parsed form is shared too
+        symbol._pins = self._pins
+        return symbol
+
+    @staticmethod
+    def _field_key_of(field):
+        if field.id < len(Symbol._FIXED_FIELDS) or field.name is None:
+            return field.id
+        return field.name
+
+    def _field_key(self, name):
+        if name in self._FIXED_FIELDS:
+            return self._FIXED_FIELDS[name]
+        return name
+
+    def _find_def(self):
+        if self._def is None:
+            raise ParseError("DEF not found in symbol '%s'", self)
+        return self._def
 
     def _find_field_or_except(self, name):
-        lineno, last = self._find_field_or_last(name)
-        if lineno is None:
+        field = self._fields.get(self._field_key(name))
+        if field is None:
             raise FieldNotFoundException(
                 "Unable to find field '%s' in symbol '%s'", name, self)
 
-        return lineno
+        return field
+
+    def field(self, name):
+        """Return the Field record for a field"""
+        return self._find_field_or_except(name)
+
+    def _add_field(self, key, name, value):
+        self._last_id += 1
+        field = Field(self._last_id, value, name=name)
+        self._last_field += 1
+        self._header.insert(self._last_field, field)
+        self._fields[key] = field
+        return field
+
+    def update_fields(self, fields):
+        """Set many fields at once.
+
+        fields maps field name to a (value, visible) pair, where visible may
+        be None to leave the visibility unchanged. Missing fields are added
+        after the existing ones, with consecutive ids in the order given.
+        Setting Name or Reference also updates the DEF line.
+
+        Returns the number of fields added."""
+        added = 0
+
+        for name, (value, visible) in fields.items():
+            key = self._field_key(name)
+            field = self._fields.get(key)
+
+            if field is not None:
+                field.set_value(value)
+                if name == 'Name':
+                    self._find_def().set_name(value)
+                elif name == 'Reference':
+                    self._find_def().set_reference(value)
+            else:
+                field = self._add_field(key, name, value)
+                added += 1
+
+            if visible is not None:
+                field.set_visible(visible)
+
+        return added
 
     def set_or_add_field(self, name, value):
-        lineno, last = self._find_field_or_last(name)
+        key = self._field_key(name)
 
-        if lineno is not None:
+        if key in self._fields:
             self.set_field(name, value)
 
         else:
-            tokens = tokenize(self._lines[last])
-            id = int(tokens[0][1:]) + 1
-            tokens = [
-                'F%d' % id,
-                quote(value), '0', '0', '50', 'H', 'I', 'L', 'CNN',
-                quote(name)
-            ]
-            #tokens[0] = 'F%d' % id
-            #tokens[1] = quote(value)
-            #tokens[6] = 'I'
-            #tokens[9] = quote(name)
-
-            self._lines.insert(last + 1, " ".join(tokens))
+            self._add_field(key, name, value)
 
     def set_visible(self, name, visible):
-        lineno = self._find_field_or_except(name)
-
-        tokens = tokenize(self._lines[lineno])
-        tokens[6] = 'V' if visible else 'I'
-        self._lines[lineno] = " ".join(tokens)
+        self._find_field_or_except(name).set_visible(visible)
 
     def has_field(self, name):
-        lineno, last = self._find_field_or_last(name)
-        if lineno is None:
-            return False
-        return True
+        return self._field_key(name) in self._fields
 
     def set_field(self, name, value, force=False):
         if not force:
@@ -166,38 +418,33 @@ class Symbol:
             elif name == 'Reference':
                 return self.set_reference(value)
 
-        lineno = self._find_field_or_except(name)
-
-        tokens = tokenize(self._lines[lineno])
-        tokens[1] = quote(value)
-        self._lines[lineno] = " ".join(tokens)
+        self._find_field_or_except(name).set_value(value)
 
     def get_field(self, name):
-        lineno = self._find_field_or_except(name)
-
-        tokens = tokenize(self._lines[lineno])
-        return unquote(tokens[1])
+        return self._find_field_or_except(name).value
 
     def set_name(self, name):
         self.set_field('Name', name, force=True)
-        lineno = self._find_def()
-        tokens = tokenize(self._lines[lineno])
-
-        tokens[1] = quote(name, if_needed=True)
-
-        self._lines[lineno] = " ".join(tokens)
+        self._find_def().set_name(name)
 
     def set_reference(self, name):
         self.set_field('Reference', name, force=True)
-        lineno = self._find_def()
-        tokens = tokenize(self._lines[lineno])
+        self._find_def().set_reference(name)
 
-        tokens[2] = quote(name, if_needed=True)
+    @property
+    def pins(self):
+        """Tuple of the symbol's Pins, parsed on first access"""
+        if self._pins is None:
+            self._pins = tuple(Pin.parse(x) for x in self._body
+                               if x.startswith('X '))
+        return self._pins
 
-        self._lines[lineno] = " ".join(tokens)
+    def find_pins(self, number):
+        """Return the pins with the given number, one per unit or convert"""
+        return [x for x in self.pins if x.number == number]
 
     def serialize(self):
-        return "\n".join(self._lines)
+        return "\n".join(chain(map(str, self._header), self._body))
 
 
 def load_lib(f):
@@ -223,3 +470,231 @@ def load_lib(f):
                                  lineno + 1)
 
     return symbols
+
+
+class PinIndex:
+    """Pins of every symbol in a library, indexed by symbol name and pin
+    number, and by electrical type.
+
+    symbols may be the list returned by load_lib() or a mapping of name to
+    Symbol such as a LazyLibrary, which will have every symbol parsed."""
+    def __init__(self, symbols):
+        if isinstance(symbols, Mapping):
+            symbols = symbols.items()
+        else:
+            symbols = ((x.get_field('Name'), x) for x in symbols)
+
+        self._by_symbol = {}
+        self._by_type = {}
+        for name, symbol in symbols:
+            by_number = {}
+            for pin in symbol.pins:
+                by_number.setdefault(pin.number, []).append(pin)
+                self._by_type.setdefault(pin.electrical_type, []).append(
+                    (name, pin))
+            self._by_symbol[name] = by_number
+
+    def symbols(self):
+        return self._by_symbol.keys()
+
+    def pin_numbers(self, symbol_name):
+        """Return the set of pin numbers of a symbol"""
+        return self._by_symbol[symbol_name].keys()
+
+    def pins(self, symbol_name, number):
+        """Return the pins of a symbol with a given number"""
+        return self._by_symbol[symbol_name].get(number, [])
+
+    def pins_of_type(self, electrical_type):
+        """Return (symbol name, Pin) for every pin of an electrical type"""
+        return self._by_type.get(electrical_type, [])
+
+
+_DEF_RE = re.compile(rb'^(?:DEF |ENDDEF)', re.MULTILINE)
+_NAME_RE = re.compile(rb'^F1 [^\r\n]*', re.MULTILINE)
+
+
+_INDEX_MAGIC = 'KICAD-LIB-INDEX 2'
+_INDEX_END = 'END'
+
+
+def index_filename(filename):
+    """Return the name of the index sidecar for a library file"""
+    return filename + '.idx'
+
+
+def write_lib_index(filename, index):
+    """Write the name -> (start, end) index of a library to its sidecar,
+    tagged with the library's current size and modification time.
+
+    The sidecar is written to a temporary file and renamed into place, so
+    concurrent readers see either the old or the new index in full."""
+    stat = os.stat(filename)
+    sidecar = index_filename(filename)
+    temp = '%s.%d.tmp' % (sidecar, os.getpid())
+    try:
+        with open(temp, 'w', encoding='utf-8') as f:
+            f.write('%s %d %d %d\n' % (_INDEX_MAGIC, stat.st_size,
+                                       stat.st_mtime_ns, len(index)))
+            for name, (start, end) in index.items():
+                f.write('%d %d %s\n' % (start, end - start, name))
+            f.write(_INDEX_END + '\n')
+        os.replace(temp, sidecar)
+    except BaseException:
+        try:
+            os.remove(temp)
+        except OSError:
+            pass
+        raise
+
+
+def read_lib_index(filename):
+    """Read the index sidecar of a library, returning None if there is no
+    sidecar, it is incomplete, or the library has changed since it was
+    written"""
+    try:
+        stat = os.stat(filename)
+        with open(index_filename(filename), 'r', encoding='utf-8') as f:
+            magic, size, mtime, count = f.readline().rstrip('\n').rsplit(' ', 3)
+            if magic != _INDEX_MAGIC or int(size) != stat.st_size or \
+                    int(mtime) != stat.st_mtime_ns:
+                return None
+
+            index = {}
+            lines = iter(f)
+            for line in lines:
+                line = line.rstrip('\n')
+                if line == _INDEX_END:
+                    break
+                start, length, name = line.split(' ', 2)
+                start = int(start)
+                index[name] = (start, start + int(length))
+            else:
+                # No end marker, the sidecar was cut short
+                return None
+
+            if len(index) != int(count) or next(lines, None) is not None:
+                return None
+            return index
+    except (OSError, ValueError):
+        return None
+
+
+class MappedFile:
+    """Base of the lazy loaders, which memory map a file and index the
+    blocks of it that start with one line and end with another.
+
+    Subclasses are closed with close() or by using them as a context
+    manager."""
+    def _open(self):
+        with open(self.filename, 'rb') as f:
+            try:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty files cannot be mapped
+                self._map = b''
+
+    def _lineno(self, pos):
+        return self._map[:pos].count(b'\n') + 1
+
+    def _index_blocks(self, block_re, begin, block_name):
+        """Return a dict of block_name(start, end) -> (start, end) for each
+        block in the file. block_re matches the start of a line beginning or
+        ending a block, and the match is begin for the beginning ones. The
+        end of a block includes the whole of its last line."""
+        index = {}
+        start = None
+        for match in block_re.finditer(self._map):
+            if match.group() == begin:
+                if start is not None:
+                    raise ParseError('%s:%d: Nested %s', self.filename,
+                                     self._lineno(match.start()),
+                                     begin.decode('utf-8').strip())
+                start = match.start()
+            else:
+                if start is None:
+                    raise ParseError('%s:%d: Unexpected %s', self.filename,
+                                     self._lineno(match.start()),
+                                     match.group().decode('utf-8').strip())
+                end = self._map.find(b'\n', match.end())
+                end = len(self._map) if end < 0 else end + 1
+                index[block_name(start, end)] = (start, end)
+                start = None
+        return index
+
+    def close(self):
+        """Unmap the file. Blocks already parsed stay available"""
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._map = b''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class LazyLibrary(Mapping, MappedFile):
+    """Read-only mapping of symbol name to Symbol for a library file.
+
+    The file is memory mapped and only scanned for the extent and name of
+    each symbol when opened. Symbols are parsed the first time they are
+    looked up. With sidecar=True the index is read from, or saved to, a
+    sidecar file next to the library so later runs can skip the scan."""
+    def __init__(self, filename, sidecar=False):
+        self.filename = filename
+        self._symbols = {}
+        self._open()
+
+        self._index = read_lib_index(filename) if sidecar else None
+        if self._index is None:
+            self._index = self._build_index()
+            if sidecar:
+                try:
+                    write_lib_index(filename, self._index)
+                except OSError:
+                    pass
+
+    def _build_index(self):
+        return self._index_blocks(_DEF_RE, b'DEF ', self._symbol_name)
+
+    def _symbol_name(self, start, end):
+        match = _NAME_RE.search(self._map, start, end)
+        if match is not None:
+            return unquote(tokenize(match.group().decode('utf-8'))[1])
+        # Fall back to the DEF line if there is no name field
+        line_end = self._map.find(b'\n', start, end)
+        return tokenize(self._map[start:line_end].decode('utf-8').strip())[1]
+
+    def byte_range(self, name):
+        """Return the (start, end) byte offsets of a symbol in the file"""
+        return self._index[name]
+
+    def __getitem__(self, name):
+        symbol = self._symbols.get(name)
+        if symbol is None:
+            start, end = self._index[name]
+            text = self._map[start:end].decode('utf-8')
+            symbol = Symbol([x.strip() for x in StringIO(text, newline=None)])
+            self._symbols[name] = symbol
+        return symbol
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __getstate__(self):
+        return {'filename': self.filename, 'index': self._index,
+                'symbols': self._symbols}
+
+    def __setstate__(self, state):
+        self.filename = state['filename']
+        self._index = state['index']
+        self._symbols = state['symbols']
+        self._open()
@@ -0,0 +1,163 @@
+__author__ = 'MegabytePhreak'
+
+import os
+from os import path
+
+import pytest
+
+from kicad_parsers.footprints import FootprintIndex, library_nickname, \
+    iter_sexpr_tokens, parse_sexpr, Footprint, load_footprint_library
+from kicad_parsers.symbols import ParseError
+
+TEST_FOOTPRINT = """\
+(module C_0402 (layer F.Cu) (tedit 553B0BD6)
+  (descr "Capacitor \\"0402\\"")
+  (fp_text reference REF** (at 0.7 1.3) (layer F.SilkS)
+    (effects (font (size 1 1) (thickness 0.15)))
+  )
+  (fp_line (start -0.9 -0.35) (end 0.9 -0.35) (layer F.CrtYd) (width 0.05))
+  (fp_line (start 0.9 0.35) (end -0.9 0.35) (layer F.CrtYd) (width 0.05))
+  (fp_line (start -0.5 -0.25) (end -0.5 0.25) (layer F.Fab) (width 0.05))
+  (pad 1 smd rect (at -0.55 0) (size 0.6 0.6) (layers F.Cu F.Paste F.Mask))
+  (pad 2 smd rect (at 0.55 0 90) (size 0.6 0.6) (layers F.Cu F.Paste F.Mask))
+  (pad "" np_thru_hole circle (at 0 0) (size 3.2 3.2) (drill 3.2) (layers *.Cu))
+  (pad 3 thru_hole oval (at 0 2) (size 2 3) (drill oval 1 2 (offset 0.1 -0.2)) (layers *.Cu))
+  (pad 4 thru_hole circle (at 0 -2) (size 1.6 1.6) (drill 0.8 (offset 0.3 0)) (layers *.Cu))
+)
+"""
+
+
+def make_library(tmpdir, names, text=None):
+    directory = path.join(str(tmpdir), 'test.pretty')
+    os.mkdir(directory)
+    for name in names:
+        with open(path.join(directory, name + '.kicad_mod'), 'w') as f:
+            f.write(text or '(module %s)\n' % name)
+    return directory
+
+
+def test_library_nickname():
+    assert library_nickname('footprints.pretty') == 'footprints'
+    assert library_nickname('lib/footprints.pretty/') == 'footprints'
+    assert library_nickname('other') == 'other'
+
+
+def test_footprint_index(tmpdir):
+    index = FootprintIndex(make_library(tmpdir, ['R_0402', 'C_0603']))
+    assert len(index) == 2
+    assert 'R_0402' in index
+    assert 'R_0603' not in index
+
+    assert index.check('test:R_0402')
+    assert not index.check('test:R_0603')
+    # Other libraries and bare names are not checked
+    assert index.check('other:R_0603')
+    assert index.check('R_0603')
+
+
+def test_footprint_index_cache(tmpdir):
+    directory = make_library(tmpdir, ['R_0402'])
+    cache_file = path.join(str(tmpdir), 'cache', 'footprints.json')
+    assert 'R_0402' in FootprintIndex(directory, cache_file)
+    assert path.exists(cache_file)
+
+    # A cache that matches the directory is used without scanning it
+    with open(cache_file, 'r') as f:
+        text = f.read()
+    with open(cache_file, 'w') as f:
+        f.write(text.replace('R_0402', 'CACHED'))
+    assert 'CACHED' in FootprintIndex(directory, cache_file)
+
+    # Touching the directory invalidates the cache
+    stat = os.stat(directory)
+    os.utime(directory, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    index = FootprintIndex(directory, cache_file)
+    assert 'R_0402' in index and 'CACHED' not in index
+
+
+def test_sexpr_tokens():
+    assert list(iter_sexpr_tokens('(a "b c" (d\n1.5))')) == \
+        ['(', 'a', 'b c', '(', 'd', '1.5', ')', ')']
+    assert list(iter_sexpr_tokens(r'(x "a\"b")')) == ['(', 'x', 'a"b', ')']
+    assert list(iter_sexpr_tokens('(x "")')) == ['(', 'x', '', ')']
+
+
+def test_parse_sexpr():
+    assert parse_sexpr('(a (b 1) "c d")') == ['a', ['b', '1'], 'c d']
+    for text in ['(a', 'a)', '(a))', '(a) (b)', 'a', '']:
+        with pytest.raises(ParseError):
+            parse_sexpr(text)
+
+
+def test_footprint():
+    footprint = Footprint(parse_sexpr(TEST_FOOTPRINT))
+    assert footprint.name == 'C_0402'
+    assert footprint.layer == 'F.Cu'
+    assert len(footprint.pads) == 5
+    assert footprint.pad_numbers() == {'1', '2', '3', '4'}
+
+    pad = footprint.pads[1]
+    assert (pad.number, pad.type, pad.shape) == ('2', 'smd', 'rect')
+    assert pad.at == (0.55, 0.0, 90.0)
+    assert pad.size == (0.6, 0.6)
+    assert pad.drill is None and pad.drill_offset is None
+    assert pad.layers == ('F.Cu', 'F.Paste', 'F.Mask')
+    assert footprint.pads[0].at == (-0.55, 0.0, 0.0)
+
+    hole, oval, offset = footprint.pads[2:]
+    assert (hole.drill, hole.drill_shape) == ((3.2, 3.2), 'circle')
+    assert (oval.drill, oval.drill_shape) == ((1.0, 2.0), 'oval')
+    assert oval.drill_offset == (0.1, -0.2)
+    assert (offset.drill, offset.drill_offset) == ((0.8, 0.8), (0.3, 0.0))
+
+    assert footprint.courtyard == [
+        ('line', ((-0.9, -0.35), (0.9, -0.35))),
+        ('line', ((0.9, 0.35), (-0.9, 0.35)))]
+    assert footprint.courtyard_bounds() == (-0.9, -0.35, 0.9, 0.35)
+
+    with pytest.raises(ParseError):
+        Footprint(parse_sexpr('(symbol x)'))
+
+
+def test_footprint_library_cache(tmpdir):
+    directory = make_library(tmpdir, ['C_0402'], TEST_FOOTPRINT)
+    cache_file = path.join(str(tmpdir), 'cache', 'footprints.marshal')
+    footprints = load_footprint_library(directory, cache_file)
+    assert list(footprints) == ['C_0402']
+    assert path.exists(cache_file)
+
+    cached = load_footprint_library(directory, cache_file)
+    assert cached['C_0402'].tree == footprints['C_0402'].tree
+
+    # A changed file is parsed again
+    filename = path.join(directory, 'C_0402.kicad_mod')
+    with open(filename, 'w') as f:
+        f.write(TEST_FOOTPRINT.replace('(pad 2', '(pad 5'))
+    stat = os.stat(filename)
+    os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    changed = load_footprint_library(directory, cache_file)
+    assert changed['C_0402'].pad_numbers() == {'1', '3', '4', '5'}
+
+
+@pytest.mark.parametrize('shape, bounds', [
+    ('(fp_circle (center 1 2) (end 1 4) (layer F.CrtYd) (width 0.05))',
+     (-1.0, 0.0, 3.0, 4.0)),
+    ('(fp_rect (start -1 -2) (end 3 1) (layer B.CrtYd) (width 0.05))',
+     (-1.0, -2.0, 3.0, 1.0)),
+    ('(fp_poly (pts (xy 0 0) (xy 2 -1) (xy 1 3)) (layer F.CrtYd) (width 0.05))',
+     (0.0, -1.0, 2.0, 3.0)),
+])
+def test_footprint_courtyard_shapes(shape, bounds):
+    footprint = Footprint(parse_sexpr(
+        '(module X (layer F.Cu) %s (fp_circle (center 0 0) (end 9 9) '
+        '(layer F.SilkS) (width 0.1)))' % shape))
+    assert len(footprint.courtyard) == 1
+    assert footprint.courtyard_bounds() == bounds
+
+
+def test_repository_hole_courtyard():
+    directory = path.join(path.dirname(__file__), '..', '..', '..',
+                          'footprints.pretty')
+    footprints = load_footprint_library(directory)
+    for name in ['HOLE_4-40', 'HOLE_4-40_PLATED']:
+        assert footprints[name].courtyard_bounds() is not None
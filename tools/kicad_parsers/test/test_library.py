@@ -0,0 +1,107 @@
+__author__ = 'MegabytePhreak'
+
+import pytest
+
+from kicad_parsers.library import DocEntry, Library, LazyDocLibrary
+from kicad_parsers.symbols import ParseError
+from kicad_parsers.test.test_symbols import TEST_LIB_DATA
+
+TEST_DCM_DATA = """\
+EESchema-DOCLIB  Version 2.0
+#
+$CMP AO6400
+D MOSFET N-CH 30V 6.9A 6-TSOP
+K mosfet n-channel
+F http://aosmd.com/res/data_sheets/AO6400.pdf
+$ENDCMP
+#
+$CMP OTHER
+D Other part
+$ENDCMP
+#
+#End Doc Library
+"""
+
+
+def test_doc_entry_roundtrip():
+    lines = TEST_DCM_DATA.split('\n')[2:7]
+    entry = DocEntry.parse(lines)
+
+    assert entry.name == 'AO6400'
+    assert entry.description == 'MOSFET N-CH 30V 6.9A 6-TSOP'
+    assert entry.keywords == 'mosfet n-channel'
+    assert entry.serialize() == '\n'.join(lines) + '\n'
+
+
+
+def test_doc_entry_keeps_line_order():
+    lines = ['$CMP X', 'K keywords', 'F datasheet', '# note', 'D description',
+             '$ENDCMP']
+    entry = DocEntry.parse(lines)
+    assert entry.extra == ('# note',)
+    assert entry.serialize() == '\n'.join(lines) + '\n'
+
+    entry.keywords = None
+    entry.description = 'changed'
+    assert entry.serialize().split('\n')[1:5] == \
+        ['F datasheet', '# note', 'D changed', '$ENDCMP']
+
+    # Fields which were not read go where they would in a new entry
+    entry = DocEntry.parse(['$CMP X', '# note', '$ENDCMP'])
+    entry.datasheet = 'ds'
+    assert entry.serialize() == '$CMP X\nF ds\n# note\n$ENDCMP\n'
+    assert DocEntry('X', 'd', 'k', 'f', ('# note',)).serialize() == \
+        '$CMP X\nD d\nK k\nF f\n# note\n$ENDCMP\n'
+
+
+def test_lazy_doc_library(tmp_path):
+    filename = tmp_path / 'test.dcm'
+    filename.write_text(TEST_DCM_DATA)
+
+    docs = LazyDocLibrary(str(filename))
+    assert list(docs) == ['AO6400', 'OTHER']
+    assert docs._entries == {}
+    assert docs['OTHER'].description == 'Other part'
+
+    with pytest.raises(ParseError):
+        filename.write_text(TEST_DCM_DATA.replace('$ENDCMP', '$CMP X', 1))
+        LazyDocLibrary(str(filename))
+
+
+def test_library(tmp_path):
+    (tmp_path / 'test.lib').write_text(TEST_LIB_DATA)
+    (tmp_path / 'test.dcm').write_text(TEST_DCM_DATA)
+
+    library = Library(str(tmp_path / 'test.lib'))
+    assert list(library) == ['AO6400']
+    assert library._docs is None
+    assert library.doc('AO6400').datasheet == \
+        'http://aosmd.com/res/data_sheets/AO6400.pdf'
+    assert library.doc('MISSING') is None
+
+    library.write(str(tmp_path / 'out.lib'))
+    copy = Library(str(tmp_path / 'out.lib'))
+    assert copy['AO6400'].serialize() == library['AO6400'].serialize()
+    assert copy.doc('AO6400').serialize() == library.doc('AO6400').serialize()
+    assert copy.doc('OTHER') is None
+
+
+def test_library_close(tmp_path):
+    (tmp_path / 'test.lib').write_text(TEST_LIB_DATA)
+    (tmp_path / 'test.dcm').write_text(TEST_DCM_DATA)
+
+    with Library(str(tmp_path / 'test.lib')) as library:
+        symbol = library['AO6400']
+        doc = library.doc('AO6400')
+        symbols_map = library.symbols._map
+        docs_map = library.docs._map
+    assert symbols_map.closed and docs_map.closed
+    # Entries parsed before closing stay available
+    assert library['AO6400'] is symbol
+    assert library.doc('AO6400') is doc
+
+
+def test_library_without_dcm(tmp_path):
+    (tmp_path / 'test.lib').write_text(TEST_LIB_DATA)
+
+    assert Library(str(tmp_path / 'test.lib')).doc('AO6400') is None
@@ -1,7 +1,14 @@
 __author__ = 'MegabytePhreak'
 
-from kicad_parsers.symbols import tokenize, quote, load_lib
+from kicad_parsers.symbols import tokenize, _tokenize_loop, quote, unquote, load_lib, \
+    LazyLibrary, ParseError, read_lib_index, index_filename, PinIndex
+import os
 from io import StringIO
+from os import path
+import pytest
+import random
+
+SYMBOLS_DIR = path.join(path.dirname(__file__), '..', '..', '..', 'symbols')
 
 #F0 "Q" 300 50 60 H V C CNN
 #F1 "A06400" 400 -50 60 H V C CNN
@@ -18,6 +25,17 @@ def test_tokenize():
     assert tokenize('F3  "http://aosmd.com/res/data_sheets/AO6400.pdf" 250    -850 60 H I C CNN  ') == \
         ['F3', '"http://aosmd.com/res/data_sheets/AO6400.pdf"', '250', '-850', '60', 'H', 'I', 'C', 'CNN']
 
+    assert tokenize('F4 "a \\"b\\" c" 0') == ['F4', '"a \\"b\\" c"', '0']
+    assert tokenize('T 0 a\\ b "c') == ['T', '0', 'a\\ b', '"c']
+
+
+def test_tokenize_matches_loop():
+    for name in ('power.lib', 'base-symbols.lib'):
+        with open(path.join(SYMBOLS_DIR, name), 'r') as f:
+            for line in f:
+                line = line.strip()
+                assert tokenize(line) == _tokenize_loop(line)
+
 
 def test_quote():
     assert quote('785-1067-1-ND') == '"785-1067-1-ND"'
@@ -27,6 +45,25 @@ def test_quote():
     assert quote('CNN', if_needed=True) == 'CNN'
 
 
+def test_unquote():
+    assert unquote('"785-1067-1-ND"') == '785-1067-1-ND'
+    assert unquote('CNN') == 'CNN'
+    assert unquote('""') == ''
+    assert unquote('"a \\"b\\""') == 'a "b"'
+    assert unquote('"a\\\\"') == 'a\\'
+    assert unquote('"a\\"') == 'a"'
+    assert unquote('"~"') == '~'
+
+
+def test_quote_unquote_roundtrip():
+    rng = random.Random(0)
+    for _ in range(2000):
+        s = ''.join(rng.choice('ab "\\~\t') for _ in range(rng.randint(0, 12)))
+        assert unquote(quote(s)) == s
+        assert unquote(quote(s, if_needed=True)) == s
+        assert unquote(tokenize('F4 %s 0' % quote(s))[1]) == s
+
+
 TEST_LIB_DATA = """
 enEESchema-LIBRARY Version 2.3
 #encoding utf-8
@@ -125,3 +162,166 @@ def test_field_create():
 
     symbol.set_or_add_field("Test Field", "Test Value")
     assert symbol.get_field("Test Field") == "Test Value"
+
+
+def test_field_create_multiple():
+    symbol = load_lib(StringIO(TEST_LIB_DATA))[0]
+
+    symbol.set_or_add_field("Field A", "A")
+    symbol.set_or_add_field("Field B", "B")
+    symbol.set_or_add_field("Field A", "A2")
+    symbol.set_visible("Field B", True)
+
+    assert symbol.get_field("Field A") == "A2"
+    assert symbol.has_field("Field B")
+    assert not symbol.has_field("Field C")
+    lines = symbol.serialize().split('\n')
+    assert lines[7] == 'F6 "A2" 0 0 50 H I L CNN "Field A"'
+    assert lines[8] == 'F7 "B" 0 0 50 H V L CNN "Field B"'
+    assert lines[9] == 'DRAW'
+
+
+def test_derive():
+    base = load_lib(StringIO(TEST_LIB_DATA))[0]
+    text = base.serialize()
+
+    symbol = base.derive()
+    symbol.set_name('abcd')
+    symbol.set_or_add_field("Test Field", "Test Value")
+
+    assert base.serialize() == text
+    assert not base.has_field("Test Field")
+    assert symbol.get_field('Name') == 'abcd'
+    assert symbol._body is base._body
+    assert symbol.serialize().endswith(text[text.index('DRAW'):])
+
+
+def test_lazy_library(tmp_path):
+    filename = tmp_path / 'test.lib'
+    filename.write_text(TEST_LIB_DATA)
+
+    library = LazyLibrary(str(filename))
+    assert list(library) == ['AO6400']
+    assert 'AO6400' in library
+    assert library._symbols == {}
+    assert library['AO6400'].serialize() == \
+        load_lib(StringIO(TEST_LIB_DATA))[0].serialize()
+
+    start, end = library.byte_range('AO6400')
+    assert TEST_LIB_DATA.encode('utf-8')[start:end].startswith(b'DEF AO6400')
+
+
+def test_lazy_library_nested_def(tmp_path):
+    filename = tmp_path / 'test.lib'
+    filename.write_text(TEST_LIB_DATA.replace('DRAW\n', 'DEF X\n', 1))
+
+    with pytest.raises(ParseError):
+        LazyLibrary(str(filename))
+
+
+def test_lazy_library_sidecar(tmp_path):
+    filename = str(tmp_path / 'test.lib')
+    with open(filename, 'w') as f:
+        f.write(TEST_LIB_DATA)
+
+    library = LazyLibrary(filename, sidecar=True)
+    assert os.path.exists(index_filename(filename))
+    assert read_lib_index(filename) == library._index
+    assert LazyLibrary(filename, sidecar=True)['AO6400'].serialize() == \
+        library['AO6400'].serialize()
+
+    with open(filename, 'a') as f:
+        f.write('#\n')
+    assert read_lib_index(filename) is None
+
+
+def test_lazy_library_sidecar_truncated(tmp_path):
+    filename = str(tmp_path / 'test.lib')
+    with open(filename, 'w') as f:
+        f.write(TEST_LIB_DATA + TEST_LIB_DATA.replace('AO6400', 'AO6401'))
+    LazyLibrary(filename, sidecar=True)
+
+    with open(index_filename(filename), 'r') as f:
+        lines = f.readlines()
+    assert lines[-1] == 'END\n'
+    assert len(lines) == 4
+
+    # A sidecar cut off at a line boundary, as seen by a reader racing a
+    # writer, or with an entry count that does not match, is not used
+    for broken in [lines[:2], lines[:3], lines[:2] + lines[3:],
+                   lines + ['extra\n']]:
+        with open(index_filename(filename), 'w') as f:
+            f.writelines(broken)
+        assert read_lib_index(filename) is None
+        assert set(LazyLibrary(filename, sidecar=True)) == {'AO6400', 'AO6401'}
+    assert not [x for x in os.listdir(str(tmp_path)) if x.endswith('.tmp')]
+
+
+def test_update_fields():
+    expected = load_lib(StringIO(TEST_LIB_DATA))[0]
+    expected.set_name('abcd')
+    expected.set_or_add_field('Field A', 'A')
+    expected.set_field('Supplier 1', 'Mouser')
+    expected.set_visible('Supplier 1', True)
+    expected.set_or_add_field('Field B', 'B')
+    expected.set_visible('Field B', True)
+    expected.set_reference('M')
+
+    symbol = load_lib(StringIO(TEST_LIB_DATA))[0]
+    added = symbol.update_fields({
+        'Name': ('abcd', None),
+        'Field A': ('A', None),
+        'Supplier 1': ('Mouser', True),
+        'Field B': ('B', True),
+        'Reference': ('M', None),
+    })
+
+    assert added == 2
+
+    assert symbol.serialize() == expected.serialize()
+    assert symbol.get_field('Field B') == 'B'
+    assert symbol.get_field('Name') == 'abcd'
+
+
+def test_field_record():
+    symbol = load_lib(StringIO(TEST_LIB_DATA.replace(
+        'F4 "Digi-Key" -700 -700', 'F4  "Digi-Key"  -700 -700')))[0]
+
+    field = symbol.field('Supplier 1')
+    assert (field.id, field.value, field.x, field.y, field.size) == \
+        (4, 'Digi-Key', '-700', '-700', '60')
+    assert (field.orientation, field.visibility, field.hjustify, field.style,
+            field.name) == ('H', 'I', 'C', 'CNN', 'Supplier 1')
+    assert symbol.serialize().split('\n')[5] == \
+        'F4  "Digi-Key"  -700 -700 60 H I C CNN "Supplier 1"'
+
+    symbol.set_visible('Supplier 1', True)
+    assert symbol.serialize().split('\n')[5] == \
+        'F4 "Digi-Key" -700 -700 60 H V C CNN "Supplier 1"'
+    assert symbol.serialize().split('\n')[1] == 'F0 "Q" 300 50 60 H V C CNN'
+
+
+def test_pins():
+    symbol = load_lib(StringIO(TEST_LIB_DATA))[0]
+
+    assert [x.number for x in symbol.pins] == ['1', '2', '3', '4', '5', '6']
+    gate = symbol.find_pins('3')[0]
+    assert (gate.name, gate.x, gate.y, gate.length, gate.orientation) == \
+        ('G', -350, -200, 200, 'R')
+    assert gate.electrical_type == 'P'
+    assert gate.electrical_type_name == 'passive'
+    assert symbol.derive().pins is symbol.pins
+
+    gate.electrical_type = 'w'
+    assert gate.electrical_type_name == 'power_out'
+    gate.electrical_type = 'X'
+    assert gate.electrical_type_name is None
+
+
+def test_pin_index():
+    index = PinIndex(load_lib(StringIO(TEST_LIB_DATA)))
+
+    assert set(index.pin_numbers('AO6400')) == {'1', '2', '3', '4', '5', '6'}
+    assert index.pins('AO6400', '4')[0].name == 'S'
+    assert index.pins('AO6400', '7') == []
+    assert len(index.pins_of_type('P')) == 6
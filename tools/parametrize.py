@@ -2,12 +2,20 @@ __author__ = 'MegabytePhreak'
 
 from argparse import ArgumentParser, FileType
 import csv
-from kicad_parsers.symbols import load_lib
-from copy import deepcopy
-from os import path
+from kicad_parsers.footprints import FootprintIndex
+from kicad_parsers.library import DocEntry, LibraryWriter
+from kicad_parsers.symbols import LazyLibrary, load_lib
+from os import getpid, makedirs, path, remove, replace
+import hashlib
 import json
+from multiprocessing import Pool, cpu_count
+import sys
+import time
 from  pprint import pprint
-from collections import OrderedDict
+from collections import Counter, OrderedDict
+import cProfile
+from contextlib import ExitStack, contextmanager, nullcontext
+import sqlite3
 
 def merge_config(base, new):
     for key,value in base.items():
@@ -22,10 +30,9 @@ def merge_config(base, new):
                     else:
                         value.append(item)
 
-def load_config(f, table):
+def resolve_config(json_config, table):
         config = { 'ignore_fields' : [], 'translate_fields' : {}, 'prepend_fields' : {}, 'visible_fields' : [] } 
-        if f:
-            json_config = json.load(f)
+        if json_config:
             merge_config(config, json_config)
             if 'tables' in json_config:
                 if table in json_config['tables']:
@@ -33,82 +40,715 @@ def load_config(f, table):
                     merge_config(config, table_config)
 
         return config
+
+def load_config(f, table):
+        return resolve_config(json.load(f) if f else None, table)
                 
 
+class _LineTracker:
+    """Line iterator over a text file which remembers the position after the
+    last line read, so csv readers can be used on seekable files"""
+    def __init__(self, f):
+        self._f = f
+        self.pos = f.tell()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self._f.readline()
+        if not line:
+            raise StopIteration
+        self.pos = self._f.tell()
+        return line
+
+
+def sorted_rows(f, key='PARTNUMBER', profile=None):
+    """Return the header of a CSV file and an iterator over its rows sorted
+    by key.
+
+    If the file is seekable only the key and file offset of each row are kept
+    in memory, and rows are re-read one at a time in sorted order. Otherwise
+    the whole table is read and sorted in memory."""
+    if not f.seekable():
+        reader = csv.DictReader(f)
+        rows = list(reader)
+        with (profile.stage('sort') if profile is not None else nullcontext()):
+            rows.sort(key=lambda x: x[key])
+        return reader.fieldnames or [], iter(rows)
+
+    lines = _LineTracker(f)
+    reader = csv.reader(lines)
+    fieldnames = next(reader, None)
+    if fieldnames is None:
+        return [], iter(())
+    key_index = fieldnames.index(key)
+
+    offsets = []
+    pos = lines.pos
+    for row in reader:
+        if row:
+            offsets.append((row[key_index], pos))
+        pos = lines.pos
+    with (profile.stage('sort') if profile is not None else nullcontext()):
+        offsets.sort(key=lambda x: x[0])
+
+    def rows():
+        for _, pos in offsets:
+            f.seek(pos)
+            yield next(csv.DictReader(iter(f.readline, ''), fieldnames))
+
+    return fieldnames, rows()
+
+
+def read_csv_rows(f, stream=False, presorted=False, key='PARTNUMBER', profile=None):
+    """Return the header of a CSV file and an iterator over its rows sorted
+    by key. Rows of presorted files are passed through as they are read.
+    If a Profile is given the time spent sorting is recorded in it."""
+    if presorted:
+        reader = csv.DictReader(f)
+        return reader.fieldnames or [], iter(reader)
+    if stream:
+        return sorted_rows(f, key, profile)
+
+    reader = csv.DictReader(f)
+    rows = list(reader)
+    with (profile.stage('sort') if profile is not None else nullcontext()):
+        rows.sort(key=lambda x: x[key])
+    return reader.fieldnames or [], iter(rows)
+
+
+def read_sqlite_rows(connection, table, where=None, key='PARTNUMBER', profile=None):
+    """Return the columns of an SQLite table and an iterator over the rows
+    matching the optional where clause, sorted by key. Values are converted
+    to strings as they would be read from a CSV export, with NULL as ''."""
+    query = 'SELECT * FROM %s' % _sqlite_identifier(table)
+    if where:
+        query += ' WHERE %s' % where
+    query += ' ORDER BY CAST(%s AS TEXT)' % _sqlite_identifier(key)
+
+    # SQLite sorts the rows before it returns the first one
+    with (profile.stage('sort') if profile is not None else nullcontext()):
+        cursor = connection.execute(query)
+    fieldnames = [x[0] for x in cursor.description]
+    rows = ({name: '' if value is None else str(value)
+             for name, value in zip(fieldnames, values)}
+            for values in cursor)
+    return fieldnames, rows
+
+
+def _sqlite_identifier(name):
+    return '"%s"' % name.replace('"', '""')
+
+
+SQLITE_PREFIX = 'sqlite:'
+
+
+def source_table(source):
+    """Return the table name for a row source, used to pick its config"""
+    if source.startswith(SQLITE_PREFIX):
+        return source.rsplit(':', 1)[1]
+    return path.splitext(path.basename(source))[0]
+
+
+@contextmanager
+def open_rows(source, stream=False, presorted=False, where=None, profile=None):
+    """Open a row source, giving its (fieldnames, rows).
+
+    source is either the name of a CSV file, '-' to read CSV from stdin or
+    sqlite:DATABASE:TABLE to query a table of an SQLite database. where is
+    an SQL condition to select rows, and is only supported for SQLite. If a
+    Profile is given the time spent sorting rows is recorded in it."""
+    if source.startswith(SQLITE_PREFIX):
+        database, table = source[len(SQLITE_PREFIX):].rsplit(':', 1)
+        # With --jobs the rows are read by the task handler thread of the
+        # worker pool, only ever one thread at a time
+        connection = sqlite3.connect(database, check_same_thread=False)
+        try:
+            yield read_sqlite_rows(connection, table, where, profile=profile)
+        finally:
+            connection.close()
+        return
+
+    if where:
+        raise ValueError("Row selection is only supported for SQLite sources, not '%s'" % source)
+
+    if source == '-':
+        yield read_csv_rows(sys.stdin, stream, presorted, profile=profile)
+    else:
+        with open(source, 'r') as f:
+            yield read_csv_rows(f, stream, presorted, profile=profile)
+
+
+def compile_config(config, fieldnames):
+    """Resolve the config for each column of a table once, returning a plan
+    of (column, field name, prefix, visible) for every column that is not
+    ignored. visible is True or None to leave the visibility unchanged."""
+    plan = []
+    for column in fieldnames:
+        if column in config['ignore_fields']:
+            continue
+        key = config['translate_fields'].get(column, column)
+        plan.append((column, key, config['prepend_fields'].get(key),
+                     True if key in config['visible_fields'] else None))
+    return plan
+
+
+def render_symbol(symbol_lib, plan, row, strict=False, counts=None, profile=None):
+    """Build the symbol for one CSV row, or return None if it is skipped.
+    If counts is given, the number of fields set and added are added to it.
+    If a Profile is given the time spent copying the base symbol and
+    updating its fields is recorded in it."""
+    symbol_name = row['SYMBOL']
+    if not strict and not symbol_name in symbol_lib:
+        print("Symbol '%s' not found for part '%s', skipping" % (symbol_name, row["PARTNUMBER"]), file=sys.stderr)
+        return None
+
+    with (profile.stage('derive') if profile is not None else nullcontext()):
+        symbol = symbol_lib[symbol_name].derive()
+    fields = {}
+
+    for column, key, prefix, visible in plan:
+        value = row[column]
+        if value == '' or value is None:
+            value = '~'
+            if key not in fields and not symbol.has_field(key):
+                continue
+        elif prefix is not None:
+            value = prefix + value
+
+        fields[key] = (value, visible)
+
+    with (profile.stage('update_fields') if profile is not None else nullcontext()):
+        added = symbol.update_fields(fields)
+    if counts is not None:
+        counts['fields_set'] += len(fields)
+        counts['fields_added'] += added
+
+    return symbol
+
+
+def format_symbol(symbol):
+    """Return the .lib and .dcm text for a generated symbol"""
+    lib_text = symbol.serialize() + '\n'
+
+    dcm_text = ''
+    if symbol.has_field('Description'):
+        dcm_text = DocEntry(symbol.get_field('Name'),
+                            symbol.get_field('Description')).serialize()
+
+    return lib_text, dcm_text
+
+
+# Part of every cache key, bump it when a change to the generator changes
+# the text generated for a row
+_CACHE_VERSION = 2
+
+
+class RenderCache:
+    """On-disk cache of the text generated for each CSV row, keyed by a hash
+    of the generator version, the base symbol, the resolved table config and
+    the row itself.
+
+    The cache file has one 'key<TAB>[lib, dcm]' line per row. Only the keys
+    and their offsets are held in memory; entries are read when they are
+    hit, and each entry used is written to the new cache file straight
+    away, which save() moves into place."""
+    def __init__(self, filename, symbol_lib, config, plan, counts=None, profile=None):
+        self.filename = filename
+        self.hits = 0
+        self.misses = 0
+        self._symbol_lib = symbol_lib
+        self._plan = plan
+        self._counts = counts
+        self._profile = profile
+        self._config_text = json.dumps(config, sort_keys=True)
+        self._base_text = {}
+        self._used = set()
+
+        self._offsets = {}
+        try:
+            self._file = open(filename, 'rb')
+        except OSError:
+            self._file = None
+        else:
+            offset = 0
+            for line in self._file:
+                key, sep, _ = line.partition(b'\t')
+                if sep:
+                    self._offsets[key.decode('ascii')] = offset
+                offset += len(line)
+
+        directory = path.dirname(filename)
+        if directory:
+            makedirs(directory, exist_ok=True)
+        self._temp = '%s.%d.tmp' % (filename, getpid())
+        self._output = open(self._temp, 'w', encoding='utf-8')
+
+    def _key(self, row):
+        symbol_name = row['SYMBOL']
+        if symbol_name not in self._base_text:
+            self._base_text[symbol_name] = self._symbol_lib[symbol_name].serialize()
+
+        data = json.dumps([_CACHE_VERSION, self._base_text[symbol_name],
+                           self._config_text, list(row.items())])
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+    def _read(self, key):
+        """Return the cached entry for key, or None"""
+        offset = self._offsets.get(key)
+        if offset is None:
+            return None
+        self._file.seek(offset)
+        try:
+            lib_text, dcm_text = json.loads(
+                self._file.readline().decode('utf-8').partition('\t')[2])
+        except ValueError:
+            return None
+        return lib_text, dcm_text
+
+    def _use(self, key, entry):
+        if key not in self._used:
+            self._used.add(key)
+            self._output.write('%s\t%s\n' % (key, json.dumps(entry)))
+
+    def render(self, row, strict=False):
+        """Return the (lib, dcm) text for row, rendering it only if it is not
+        already cached, or None if the row is skipped"""
+        if row['SYMBOL'] not in self._symbol_lib:
+            return render_symbol(self._symbol_lib, self._plan, row, strict)
+
+        key = self._key(row)
+        entry = self._read(key)
+        if entry is None:
+            self.misses += 1
+            entry = format_symbol(render_symbol(self._symbol_lib, self._plan, row, strict,
+                                                self._counts, self._profile))
+        else:
+            self.hits += 1
+        self._use(key, entry)
+        return entry
+
+    def render_all(self, rows, render_rows, strict=False):
+        """Yield the (lib, dcm) text for each row like render(), passing all
+        the rows missing from the cache to render_rows in one go. Unlike
+        render(), this holds every row and cached entry in memory.
+
+        Each entry is read once, before the misses are chosen, so an entry
+        which cannot be read is rendered like a missing one."""
+        keyed = []
+        for row in rows:
+            if row['SYMBOL'] in self._symbol_lib:
+                key = self._key(row)
+                keyed.append((row, key, self._read(key)))
+            else:
+                keyed.append((row, None, None))
+        rendered = render_rows(row for row, key, entry in keyed
+                               if key is not None and entry is None)
+
+        for row, key, entry in keyed:
+            if key is None:
+                yield render_symbol(self._symbol_lib, self._plan, row, strict)
+                continue
+
+            if entry is None:
+                self.misses += 1
+                entry = next(rendered)
+            else:
+                self.hits += 1
+            self._use(key, entry)
+            yield entry
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._output.close()
+
+    def save(self, prune=True):
+        """Replace the cache with the entries used since loading, dropping
+        stale ones unless prune is False"""
+        if not prune and self._file is not None:
+            self._file.seek(0)
+            for line in self._file:
+                key, sep, _ = line.partition(b'\t')
+                if sep and key.decode('ascii') not in self._used:
+                    self._output.write(line.decode('utf-8'))
+        self._close()
+        replace(self._temp, self.filename)
+
+    def discard(self):
+        """Leave the cache as it was loaded"""
+        self._close()
+        try:
+            remove(self._temp)
+        except OSError:
+            pass
+
+
+# Rows are sent to render workers in chunks to amortise the IPC overhead
+_RENDER_CHUNKSIZE = 32
+
+# State shared with row render worker processes, set up once per worker
+_render_state = {}
+
+
+def _init_render_worker(symbol_lib, plan, strict, profile):
+    _render_state['symbol_lib'] = symbol_lib
+    _render_state['plan'] = plan
+    _render_state['strict'] = strict
+    _render_state['profile'] = profile
+
+
+def _render_row(row):
+    counts = Counter()
+    profile = Profile() if _render_state['profile'] else None
+    symbol = render_symbol(_render_state['symbol_lib'], _render_state['plan'],
+                           row, _render_state['strict'], counts, profile)
+    entry = format_symbol(symbol) if symbol is not None else None
+    return (entry, counts['fields_set'], counts['fields_added'],
+            profile.seconds if profile is not None else None)
+
+
+def _pool_render(pool, rows, counts, profile=None):
+    """Render rows in a worker pool, yielding their text in order"""
+    for entry, fields_set, fields_added, seconds in pool.imap(_render_row, rows, _RENDER_CHUNKSIZE):
+        counts['fields_set'] += fields_set
+        counts['fields_added'] += fields_added
+        if profile is not None:
+            profile.add(seconds)
+        yield entry
+
+
+class Profile:
+    """Wall time spent in each stage of generating a library, and counts of
+    the work done. Time in a nested stage is not counted in the outer one.
+    Stages timed in worker processes are added up over all the workers."""
+    def __init__(self):
+        self.seconds = OrderedDict()
+        self.counts = Counter(rows=0, symbols_skipped=0, fields_set=0,
+                              fields_added=0)
+        self._nested = []
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        self._nested.append(0.0)
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = self._nested.pop()
+            self.seconds[name] = self.seconds.get(name, 0.0) + elapsed - nested
+            if self._nested:
+                self._nested[-1] += elapsed
+
+    def iterate(self, name, iterable):
+        """Wrap an iterator, counting the time taken to produce each item
+        against stage name"""
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def add(self, seconds):
+        """Add the stage times of another Profile"""
+        for name, value in seconds.items():
+            self.seconds[name] = self.seconds.get(name, 0.0) + value
+
+    def to_json(self):
+        return {'seconds': self.seconds, 'counts': self.counts}
+
+
+def check_footprints(rows, plan, symbol_lib, footprints, counts):
+    """Pass rows through, reporting any generated part whose Footprint field
+    refers to a footprint missing from the FootprintIndex footprints"""
+    columns = [(column, prefix or '') for column, key, prefix, visible in plan
+               if key == 'Footprint']
+    for row in rows:
+        if row['SYMBOL'] in symbol_lib:
+            for column, prefix in columns:
+                value = row[column]
+                if value and not footprints.check(prefix + value):
+                    counts['footprints_missing'] += 1
+                    print("Footprint '%s' not found for part '%s'" % (prefix + value, row['PARTNUMBER']),
+                          file=sys.stderr)
+        yield row
+
+
+@contextmanager
+def _replacing(filename):
+    """Open a temporary file to write filename through. It replaces filename
+    when the block completes, and is removed if it fails, so the old file is
+    never left half written."""
+    temp = '%s.%d.tmp' % (filename, getpid())
+    try:
+        with open(temp, 'w') as f:
+            yield f
+        replace(temp, filename)
+    except BaseException:
+        try:
+            remove(temp)
+        except OSError:
+            pass
+        raise
+
+
+def parametrize_table(symbol_lib, config, fieldnames, rows, output_name, strict=False, stream=False, cache_dir=None, jobs=1, profile=None, footprints=None, partial=False):
+    """Generate the .lib and .dcm libraries output_name from the sorted rows
+    of one table, as given by open_rows(). If the rows are only part of the
+    table, partial must be set so cache entries of other rows are kept.
+
+    With jobs > 1 rows are rendered by a pool of worker processes, and
+    written in the same order as the serial path. If a Profile is given the
+    time spent reading, rendering and writing rows is recorded in it. If a
+    FootprintIndex is given, missing footprints are reported."""
+    counts = profile.counts if profile is not None else Counter()
+    jobs = jobs or cpu_count()
+
+    # With a pool, rows are read by its task handler thread, so reading is
+    # counted as part of rendering
+    if profile is not None and jobs <= 1:
+        rows = profile.iterate('read_rows', rows)
+
+    plan = compile_config(config, fieldnames)
+    if footprints is not None:
+        rows = check_footprints(rows, plan, symbol_lib, footprints, counts)
+
+    # The cache writes its new file as it goes, which must be discarded if
+    # anything fails before it is saved
+    cache = None
+    try:
+        with (Pool(jobs, _init_render_worker, (symbol_lib, plan, strict, profile is not None))
+              if jobs > 1 else nullcontext()) as pool:
+            if cache_dir is not None:
+                cache = RenderCache(
+                    path.join(cache_dir, 'rows', path.basename(output_name) + '.tsv'),
+                    symbol_lib, config, plan, counts, profile)
+                if pool is not None:
+                    entries = cache.render_all(
+                        rows, lambda x: _pool_render(pool, x, counts, profile), strict)
+                else:
+                    entries = (cache.render(row, strict) for row in rows)
+            else:
+                if pool is not None:
+                    entries = _pool_render(pool, rows, counts, profile)
+                else:
+                    entries = (render_symbol(symbol_lib, plan, row, strict, counts, profile) for row in rows)
+                    entries = (format_symbol(x) if x is not None else None for x in entries)
+
+            if profile is not None:
+                entries = profile.iterate('render', entries)
+            if not stream:
+                entries = list(entries)
+
+            with _replacing("%s.lib" % output_name) as lib_output, \
+                    _replacing("%s.dcm" % output_name) as dcm_output, \
+                    (profile.stage('write') if profile is not None else nullcontext()):
+                writer = LibraryWriter(lib_output, dcm_output)
+                for entry in entries:
+                    counts['rows'] += 1
+                    if entry is not None:
+                        writer.write_text(entry[0], entry[1])
+                    else:
+                        counts['symbols_skipped'] += 1
+
+        if cache is not None:
+            cache.save(prune=not partial)
+    except BaseException:
+        if cache is not None:
+            cache.discard()
+        raise
+
+    if cache is not None:
+        counts['rows_cached'] += cache.hits
+        print("%s: %d rows cached, %d rendered" % (path.basename(output_name), cache.hits, cache.misses),
+              file=sys.stderr)
+
+def load_symbol_lib(f):
+    """Load the base library, lazily if it is a regular file"""
+    if path.isfile(f.name):
+        f.close()
+        return LazyLibrary(f.name, sidecar=True)
+    return {x.get_field('Name'): x for x in load_lib(f)}
+
+
+def load_footprints(directory, cache_dir=None):
+    """Index the footprint library to check footprints against, if any"""
+    if directory is None:
+        return None
+    cache_file = path.join(cache_dir, 'footprints.json') if cache_dir else None
+    return FootprintIndex(directory, cache_file)
+
+
 def parametrize(args = None):
 
     parser = ArgumentParser(description='Parametrize Kicad Libraries from CSV files')
 
     parser.add_argument('library', type=FileType('r'),
                         help='Library to use as a basis for parametrization')
-    parser.add_argument('csv', type=FileType('r'),
-                        help='CSV file with rows for each parametrization of a symbol')
+    parser.add_argument('source', type=str,
+                        help="CSV file with rows for each parametrization of a symbol, '-' for stdin, or sqlite:DATABASE:TABLE")
     parser.add_argument('output_name', type=str, default='.',
                         help='Name to give to output libraries')
     parser.add_argument('--strict', type=bool, default=False,
                         help='Require all symbols to be present')
     parser.add_argument('-C','--config', type=FileType('r'), default=None, 
                         help='Configuration File')
+    parser.add_argument('--stream', action='store_true',
+                        help='Write each symbol as it is generated instead of building the whole library in memory')
+    parser.add_argument('--cache', type=str, default=None, metavar='DIR',
+                        help='Directory for a cache of generated rows, so only changed rows are regenerated')
+    parser.add_argument('--footprints', type=str, default=None, metavar='DIR',
+                        help='Footprint library (.pretty directory) to check the footprints of generated parts against')
+    parser.add_argument('-j','--jobs', type=int, default=1,
+                        help='Number of processes to render rows with, 0 to use all cores')
+    parser.add_argument('--presorted', action='store_true',
+                        help='CSV rows are already sorted by PARTNUMBER, so process them as they are read')
+    parser.add_argument('--where', type=str, default=None,
+                        help='SQL condition selecting the rows to use from an SQLite source. The output must not exist yet, as it only holds the selected rows')
+    parser.add_argument('--profile', type=FileType('w'), default=None, metavar='FILE',
+                        help="Write the time spent in each stage and counts of the work done as JSON, '-' for stdout")
+    parser.add_argument('--cprofile', type=str, default=None, metavar='FILE',
+                        help='Run under cProfile and dump the statistics to FILE')
     
-    if args:
-        args = parser.parse_args(args)
-    else:
-        args = parser.parse_args()
+    args = parser.parse_args(args)
 
-    config = load_config(args.config, path.basename(args.output_name))
+    if args.where and not args.source.startswith(SQLITE_PREFIX):
+        parser.error('--where is only supported for SQLite sources')
+    if args.where and path.exists('%s.lib' % args.output_name):
+        parser.error("--where only generates the selected rows, refusing to overwrite '%s.lib'" % args.output_name)
+
+    profile = Profile() if args.profile else None
+    profiler = cProfile.Profile() if args.cprofile else None
+    if profiler is not None:
+        profiler.enable()
+
+    with (profile.stage('load_config') if profile else nullcontext()):
+        config = load_config(args.config, path.basename(args.output_name))
     #pprint(config)
     
-    symbol_lib = {x.get_field('Name'): x for x in load_lib(args.library)}
-    symbols = []
+    with (profile.stage('load_library') if profile else nullcontext()):
+        symbol_lib = load_symbol_lib(args.library)
 
+    with (profile.stage('load_footprints') if profile else nullcontext()):
+        footprints = load_footprints(args.footprints, args.cache)
+
+    with ExitStack() as stack:
+        # Only opening the source is counted here, the time spent reading rows
+        # once generation starts is counted by parametrize_table
+        with (profile.stage('read_rows') if profile else nullcontext()):
+            fieldnames, rows = stack.enter_context(
+                open_rows(args.source, args.stream, args.presorted, args.where, profile))
+        parametrize_table(symbol_lib, config, fieldnames, rows, args.output_name,
+                          strict=args.strict, stream=args.stream, cache_dir=args.cache,
+                          jobs=args.jobs, profile=profile, footprints=footprints,
+                          partial=args.where is not None)
+
+    if isinstance(symbol_lib, LazyLibrary):
+        symbol_lib.close()
+
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.cprofile)
+
+    if profile is not None:
+        json.dump(profile.to_json(), args.profile, indent=1)
+        args.profile.write('\n')
+
+
+# State shared with batch worker processes, set up once per worker
+_batch_state = {}
+
+
+def _init_batch_worker(symbol_lib, json_config, strict, cache_dir, where, footprints):
+    _batch_state['symbol_lib'] = symbol_lib
+    _batch_state['json_config'] = json_config
+    _batch_state['strict'] = strict
+    _batch_state['cache_dir'] = cache_dir
+    _batch_state['footprints'] = footprints
+    _batch_state['where'] = where
+
+
+def _parametrize_batch_table(source, output_dir):
+    table = source_table(source)
+    config = resolve_config(_batch_state['json_config'], table)
+    where = _batch_state['where'] if source.startswith(SQLITE_PREFIX) else None
+    with open_rows(source, stream=True, where=where) as (fieldnames, rows):
+        parametrize_table(_batch_state['symbol_lib'], config, fieldnames, rows,
+                          path.join(output_dir, table),
+                          strict=_batch_state['strict'], stream=True,
+                          cache_dir=_batch_state['cache_dir'],
+                          footprints=_batch_state['footprints'],
+                          partial=where is not None)
+    return table
+
+
+def parametrize_batch(args = None):
+
+    parser = ArgumentParser(prog='%s batch' % path.basename(sys.argv[0]),
+                            description='Parametrize Kicad Libraries from several tables at once')
+
+    parser.add_argument('library', type=FileType('r'),
+                        help='Library to use as a basis for parametrization')
+    parser.add_argument('output_dir', type=str,
+                        help='Directory to write the output libraries to, named after each table')
+    parser.add_argument('sources', type=str, nargs='+',
+                        help='CSV files with rows for each parametrization of a symbol, or sqlite:DATABASE:TABLE')
+    parser.add_argument('--strict', type=bool, default=False,
+                        help='Require all symbols to be present')
+    parser.add_argument('-C','--config', type=FileType('r'), default=None,
+                        help='Configuration File')
+    parser.add_argument('-j','--jobs', type=int, default=1,
+                        help='Number of tables to generate in parallel, 0 to use all cores')
+    parser.add_argument('--cache', type=str, default=None, metavar='DIR',
+                        help='Directory for a cache of generated rows, so only changed rows are regenerated')
+    parser.add_argument('--footprints', type=str, default=None, metavar='DIR',
+                        help='Footprint library (.pretty directory) to check the footprints of generated parts against')
+    parser.add_argument('--where', type=str, default=None,
+                        help='SQL condition selecting the rows to use from SQLite sources. Their outputs must not exist yet, as they only hold the selected rows')
+
+    args = parser.parse_args(args)
+
+    if args.where:
+        for source in args.sources:
+            output_name = path.join(args.output_dir, source_table(source))
+            if source.startswith(SQLITE_PREFIX) and path.exists('%s.lib' % output_name):
+                parser.error("--where only generates the selected rows, refusing to overwrite '%s.lib'" % output_name)
+
+    json_config = json.load(args.config) if args.config else None
+    symbol_lib = load_symbol_lib(args.library)
+    footprints = load_footprints(args.footprints, args.cache)
+
+    jobs = args.jobs or cpu_count()
+    jobs = min(jobs, len(args.sources))
+    if jobs <= 1:
+        _init_batch_worker(symbol_lib, json_config, args.strict, args.cache, args.where, footprints)
+        for source in args.sources:
+            _parametrize_batch_table(source, args.output_dir)
+    else:
+        with Pool(jobs, _init_batch_worker,
+                  (symbol_lib, json_config, args.strict, args.cache, args.where, footprints)) as pool:
+            pool.starmap(_parametrize_batch_table,
+                         [(source, args.output_dir) for source in args.sources])
+
+    if isinstance(symbol_lib, LazyLibrary):
+        symbol_lib.close()
+
+
+def main(args = None):
+    """Generate one table, or several with a leading 'batch' argument"""
+    if args is None:
+        args = sys.argv[1:]
+    if args[:1] == ['batch']:
+        parametrize_batch(args[1:])
+    else:
+        parametrize(args)
 
-    csv_data = csv.DictReader(args.csv)
-    csv_data = list(csv_data)
-    csv_data.sort(key=lambda x: x['PARTNUMBER'])
-    
-    for row in csv_data:
-        symbol_name = row['SYMBOL']
-        if not args.strict and not symbol_name in symbol_lib:
-            print("Symbol '%s' not found for part '%s', skipping" % (symbol_name, row["PARTNUMBER"]))
-            continue
-            
-        symbol = deepcopy(symbol_lib[symbol_name])
-    
-        for key,value in row.items():
-            if key in config['ignore_fields']:
-                continue
-            if key in config['translate_fields']:
-                key = config['translate_fields'][key]
-
-                    
-            if value == '' or value is None:
-                value = '~'
-                if not symbol.has_field(key):
-                    continue
-            elif key in config['prepend_fields']:
-                value = config['prepend_fields'][key] + value
-                    
-            #print("Adding field '%s' = '%s'" % (key, value))
-            symbol.set_or_add_field(key,value)
-
-            if key in config['visible_fields']:
-                symbol.set_visible(key, True);
-
-        symbols.append(symbol)
-
-    with open("%s.lib" % args.output_name, 'w') as output:
-        output.write('EESchema-LIBRARY Version 2.4\n')
-        for symbol in symbols:
-            output.write(symbol.serialize())
-            output.write('\n')
-
-    with open("%s.dcm" % args.output_name, 'w') as output:
-        output.write('EESchema-DOCLIB  Version 2.0\n')
-        for symbol in symbols:
-            if symbol.has_field('Description'):
-                output.write('$CMP %s\n' % symbol.get_field('Name'))
-                output.write('D %s\n' % symbol.get_field('Description'))
-                output.write('$ENDCMP\n')
 
 if __name__ == '__main__':
-    parametrize()
+    main()
@@ -0,0 +1,382 @@
+__author__ = 'MegabytePhreak'
+
+import csv
+from io import StringIO
+import json
+import os
+from os import path
+import random
+import sqlite3
+import sys
+
+import pytest
+
+from kicad_parsers.symbols import load_lib
+from kicad_parsers.test.test_symbols import TEST_LIB_DATA
+from parametrize import Profile, compile_config, main, open_rows, parametrize, parametrize_table, \
+    read_csv_rows, read_sqlite_rows, resolve_config, sorted_rows
+
+CONFIG = {
+    'ignore_fields': ['SYMBOL'],
+    'translate_fields': {'PARTNUMBER': 'Name', 'DESCRIPTION': 'Description',
+                         'FOOTPRINT': 'Footprint', 'VALUE': 'Resistance'},
+    'prepend_fields': {'Footprint': 'footprints:'},
+    'visible_fields': ['VALUE'],
+}
+
+COLUMNS = ['SYMBOL', 'PARTNUMBER', 'VALUE', 'FOOTPRINT', 'DESCRIPTION', 'Supplier 1']
+
+
+def make_rows(count=100, seed=0):
+    """Rows for the AO6400 test symbol in a shuffled order, with a few using
+    a missing symbol and some empty values"""
+    rng = random.Random(seed)
+    rows = []
+    for i in range(count):
+        rows.append({
+            'SYMBOL': 'MISSING' if i % 17 == 5 else 'AO6400',
+            'PARTNUMBER': 'Q%05d' % i,
+            'VALUE': '%d "ohm"' % rng.randrange(1000),
+            'FOOTPRINT': rng.choice(['SOT-23', 'TSOP-6', '']),
+            'DESCRIPTION': '' if i % 7 == 3 else 'MOSFET, part %d' % i,
+            'Supplier 1': rng.choice(['Digi-Key', 'Mouser', '']),
+        })
+    rng.shuffle(rows)
+    return rows
+
+
+def write_csv(filename, rows):
+    with open(filename, 'w', newline='') as f:
+        writer = csv.DictWriter(f, COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+    return filename
+
+
+@pytest.fixture
+def symbol_lib():
+    return {x.get_field('Name'): x for x in load_lib(StringIO(TEST_LIB_DATA))}
+
+
+@pytest.fixture
+def table(tmpdir):
+    return write_csv(path.join(str(tmpdir), 'table.csv'), make_rows())
+
+
+def generate(symbol_lib, source, output_name, stream=False, where=None, **kwargs):
+    """Run parametrize_table on source, returning the .lib and .dcm text"""
+    config = resolve_config(CONFIG, 'table')
+    with open_rows(source, stream, where=where) as (fieldnames, rows):
+        parametrize_table(symbol_lib, config, fieldnames, rows, output_name,
+                          stream=stream, **kwargs)
+    with open(output_name + '.lib') as lib, open(output_name + '.dcm') as dcm:
+        return lib.read(), dcm.read()
+
+
+def test_jobs_broken_cache(tmpdir, symbol_lib, table):
+    tmpdir = str(tmpdir)
+    cache_dir = path.join(tmpdir, 'cache')
+    expected = generate(symbol_lib, table, path.join(tmpdir, 'serial'))
+
+    generate(symbol_lib, table, path.join(tmpdir, 'cached'), cache_dir=cache_dir)
+    cache_file = path.join(cache_dir, 'rows', 'cached.tsv')
+    with open(cache_file) as f:
+        lines = f.readlines()
+    # Break one entry and drop another, so the first is read but is a miss
+    lines[3] = lines[3][:lines[3].index('\t') + 5] + '\n'
+    del lines[10]
+    with open(cache_file, 'w') as f:
+        f.writelines(lines)
+
+    assert generate(symbol_lib, table, path.join(tmpdir, 'cached'),
+                    cache_dir=cache_dir, jobs=3) == expected
+    assert generate(symbol_lib, table, path.join(tmpdir, 'cached'),
+                    cache_dir=cache_dir, jobs=3, stream=True) == expected
+
+
+def test_failed_stream_keeps_output(tmpdir, symbol_lib, table):
+    output_name = path.join(str(tmpdir), 'out')
+    expected = generate(symbol_lib, table, output_name, stream=True)
+
+    # The MISSING rows fail in strict mode, after some rows are written
+    with pytest.raises(KeyError):
+        generate(symbol_lib, table, output_name, stream=True, strict=True)
+    with open(output_name + '.lib') as lib, open(output_name + '.dcm') as dcm:
+        assert (lib.read(), dcm.read()) == expected
+    assert sorted(tmpdir.listdir(lambda x: x.ext == '.tmp')) == []
+
+
+@pytest.mark.parametrize('stream', [False, True])
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_failed_run_keeps_cache(tmpdir, symbol_lib, table, stream, jobs):
+    output_name = path.join(str(tmpdir), 'out')
+    cache_dir = path.join(str(tmpdir), 'cache')
+    generate(symbol_lib, table, output_name, cache_dir=cache_dir)
+    cache_files = tmpdir.join('cache', 'rows').listdir()
+    cache_text = [x.read() for x in cache_files]
+
+    with pytest.raises(KeyError):
+        generate(symbol_lib, table, output_name, stream=stream, strict=True,
+                 cache_dir=cache_dir, jobs=jobs)
+    assert tmpdir.join('cache', 'rows').listdir() == cache_files
+    assert [x.read() for x in cache_files] == cache_text
+    assert tmpdir.listdir(lambda x: x.ext == '.tmp') == []
+
+
+def test_cache_names(tmpdir, symbol_lib):
+    # A table named like the footprint index cache must not share its file
+    table = write_csv(path.join(str(tmpdir), 'footprints.csv'), make_rows(10))
+    cache_dir = path.join(str(tmpdir), 'cache')
+    generate(symbol_lib, table, path.join(str(tmpdir), 'footprints'), cache_dir=cache_dir)
+    assert tmpdir.join('cache', 'rows', 'footprints.tsv').check(file=1)
+    assert not tmpdir.join('cache', 'footprints.json').check()
+
+
+def test_stream(tmpdir, symbol_lib, table):
+    tmpdir = str(tmpdir)
+    expected = generate(symbol_lib, table, path.join(tmpdir, 'serial'))
+    assert expected[0].count('\nDEF Q') == 94
+    assert generate(symbol_lib, table, path.join(tmpdir, 'stream'), stream=True) == expected
+
+
+def test_sorted_rows(tmpdir):
+    rows = make_rows(50)
+    # Fields with line breaks and quotes span several lines of the file
+    rows[3]['DESCRIPTION'] = 'two\nlines, "quoted"'
+    rows[40]['DESCRIPTION'] = 'three\r\nline\nfield'
+    filename = write_csv(path.join(str(tmpdir), 'table.csv'), rows)
+    expected = sorted(rows, key=lambda x: x['PARTNUMBER'])
+
+    with open(filename, newline='') as f:
+        fieldnames, sorted_iter = sorted_rows(f)
+        assert fieldnames == COLUMNS
+        assert list(sorted_iter) == expected
+
+    # Files which cannot seek are sorted in memory
+    with open(filename, newline='') as f:
+        text = StringIO(f.read())
+    text.seekable = lambda: False
+    fieldnames, sorted_iter = read_csv_rows(text, stream=True)
+    assert fieldnames == COLUMNS
+    assert list(sorted_iter) == expected
+
+
+def test_sorted_rows_empty():
+    fieldnames, rows = sorted_rows(StringIO(''))
+    assert (fieldnames, list(rows)) == ([], [])
+    fieldnames, rows = sorted_rows(StringIO('SYMBOL,PARTNUMBER\n'))
+    assert (fieldnames, list(rows)) == (['SYMBOL', 'PARTNUMBER'], [])
+
+
+def cache_keys(cache_dir, table='out'):
+    with open(path.join(cache_dir, 'rows', table + '.tsv')) as f:
+        return {line.split('\t')[0] for line in f}
+
+
+def test_cache(tmpdir, symbol_lib):
+    tmpdir = str(tmpdir)
+    rows = make_rows()
+    table = write_csv(path.join(tmpdir, 'table.csv'), rows)
+    output_name = path.join(tmpdir, 'out')
+    cache_dir = path.join(tmpdir, 'cache')
+
+    def cached(**kwargs):
+        profile = Profile()
+        text = generate(symbol_lib, table, output_name, cache_dir=cache_dir,
+                        profile=profile, **kwargs)
+        assert text == generate(symbol_lib, table, path.join(tmpdir, 'serial'))
+        return profile.counts['rows_cached']
+
+    assert cached() == 0
+    assert len(cache_keys(cache_dir)) == 94
+    assert cached() == 94
+    assert cached(stream=True) == 94
+
+    # Only changed rows are rendered again, and stale entries are pruned
+    old_keys = cache_keys(cache_dir)
+    rows[0]['VALUE'] = 'changed'
+    rows[1]['DESCRIPTION'] = 'changed'
+    write_csv(table, rows)
+    assert cached() == 94 - 2
+    assert len(cache_keys(cache_dir)) == 94
+    assert len(cache_keys(cache_dir) - old_keys) == 2
+
+    # A change to the base symbol renders every row again
+    symbol_lib['AO6400'] = symbol_lib['AO6400'].derive()
+    symbol_lib['AO6400'].set_field('Supplier 1', 'changed')
+    assert cached() == 0
+
+
+def test_cache_partial(tmpdir, symbol_lib):
+    tmpdir = str(tmpdir)
+    rows = make_rows()
+    cache_dir = path.join(tmpdir, 'cache')
+    output_name = path.join(tmpdir, 'out')
+    generate(symbol_lib, write_csv(path.join(tmpdir, 'table.csv'), rows),
+             output_name, cache_dir=cache_dir)
+    full_keys = cache_keys(cache_dir)
+
+    # A run over part of the table keeps the entries of the other rows
+    table = write_csv(path.join(tmpdir, 'part.csv'), rows[:10])
+    generate(symbol_lib, table, output_name, cache_dir=cache_dir, partial=True)
+    assert cache_keys(cache_dir) == full_keys
+
+    generate(symbol_lib, table, output_name, cache_dir=cache_dir)
+    assert len(cache_keys(cache_dir)) == len([x for x in rows[:10]
+                                              if x['SYMBOL'] == 'AO6400'])
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_jobs(tmpdir, symbol_lib, table, stream):
+    tmpdir = str(tmpdir)
+    cache_dir = path.join(tmpdir, 'cache')
+    expected = generate(symbol_lib, table, path.join(tmpdir, 'serial'))
+
+    profile = Profile()
+    assert generate(symbol_lib, table, path.join(tmpdir, 'jobs'), stream=stream,
+                    jobs=2, profile=profile) == expected
+    assert profile.counts['rows'] == 100
+    assert profile.counts['symbols_skipped'] == 6
+
+    for _ in range(2):
+        assert generate(symbol_lib, table, path.join(tmpdir, 'cached'), stream=stream,
+                        jobs=2, cache_dir=cache_dir) == expected
+
+
+def write_sqlite(filename, rows, table='parts'):
+    """Write rows to an SQLite table, with empty values as NULL"""
+    connection = sqlite3.connect(filename)
+    with connection:
+        connection.execute('CREATE TABLE %s (%s)' % (
+            table, ', '.join('"%s" TEXT' % x for x in COLUMNS)))
+        connection.executemany(
+            'INSERT INTO %s VALUES (%s)' % (table, ', '.join('?' * len(COLUMNS))),
+            [[x[column] or None for column in COLUMNS] for x in rows])
+    connection.close()
+    return filename
+
+
+def test_read_sqlite_rows(tmpdir):
+    rows = make_rows(20)
+    connection = sqlite3.connect(write_sqlite(path.join(str(tmpdir), 'parts.sqlite'), rows))
+    connection.execute('ALTER TABLE parts ADD COLUMN "PINS" INTEGER')
+    connection.execute('UPDATE parts SET PINS = 6 WHERE PARTNUMBER = \'Q00002\'')
+    try:
+        fieldnames, result = read_sqlite_rows(connection, 'parts')
+        result = list(result)
+        assert fieldnames == COLUMNS + ['PINS']
+        assert [x['PARTNUMBER'] for x in result] == sorted(x['PARTNUMBER'] for x in rows)
+        assert result[2]['PINS'] == '6'
+        assert result[3]['PINS'] == ''
+        assert [dict(x, PINS=None) for x in result] == \
+            sorted((dict(x, PINS=None) for x in rows), key=lambda x: x['PARTNUMBER'])
+
+        fieldnames, result = read_sqlite_rows(connection, 'parts', "SYMBOL = 'MISSING'")
+        assert [x['PARTNUMBER'] for x in result] == ['Q00005']
+    finally:
+        connection.close()
+
+
+def test_sources(tmpdir, symbol_lib, monkeypatch):
+    tmpdir = str(tmpdir)
+    rows = make_rows()
+    table = write_csv(path.join(tmpdir, 'table.csv'), rows)
+    database = write_sqlite(path.join(tmpdir, 'parts.sqlite'), rows)
+    expected = generate(symbol_lib, table, path.join(tmpdir, 'csv'))
+
+    source = 'sqlite:%s:parts' % database
+    assert generate(symbol_lib, source, path.join(tmpdir, 'sqlite')) == expected
+    assert generate(symbol_lib, source, path.join(tmpdir, 'sqlite'), stream=True,
+                    jobs=2) == expected
+
+    with open(table) as f:
+        monkeypatch.setattr(sys, 'stdin', f)
+        assert generate(symbol_lib, '-', path.join(tmpdir, 'stdin')) == expected
+
+    presorted = write_csv(path.join(tmpdir, 'presorted.csv'),
+                          sorted(rows, key=lambda x: x['PARTNUMBER']))
+    with open_rows(presorted, presorted=True) as (fieldnames, result):
+        assert list(result) == sorted(rows, key=lambda x: x['PARTNUMBER'])
+
+    with pytest.raises(ValueError):
+        with open_rows(table, where='1'):
+            pass
+
+
+def test_where(tmpdir):
+    tmpdir = str(tmpdir)
+    rows = make_rows()
+    database = write_sqlite(path.join(tmpdir, 'parts.sqlite'), rows)
+    library = path.join(tmpdir, 'base.lib')
+    with open(library, 'w') as f:
+        f.write(TEST_LIB_DATA)
+    config = path.join(tmpdir, 'config.json')
+    with open(config, 'w') as f:
+        json.dump(CONFIG, f)
+    source = 'sqlite:%s:parts' % database
+    cache_dir = path.join(tmpdir, 'cache')
+
+    def run(output, *args):
+        parametrize([library, source, path.join(tmpdir, output), '--config', config,
+                     '--cache', cache_dir] + list(args))
+
+    run('parts')
+    full_keys = cache_keys(cache_dir, 'parts')
+
+    with pytest.raises(SystemExit):
+        run('parts', '--where', "PARTNUMBER < 'Q00010'")
+    run('selected', '--where', "PARTNUMBER < 'Q00010'")
+    with open(path.join(tmpdir, 'selected.lib')) as f:
+        assert f.read().count('\nDEF ') == 9
+    assert cache_keys(cache_dir, 'parts') == full_keys
+
+    with pytest.raises(SystemExit):
+        parametrize([library, path.join(tmpdir, 'table.csv'), path.join(tmpdir, 'csv'),
+                     '--where', '1'])
+
+
+def test_compile_config():
+    config = resolve_config(dict(CONFIG, visible_fields=['Resistance', 'Supplier 1'],
+                                 tables={'table': {'ignore_fields': ['DESCRIPTION']}}),
+                            'table')
+    assert compile_config(config, COLUMNS + ['EXTRA']) == [
+        ('PARTNUMBER', 'Name', None, None),
+        ('VALUE', 'Resistance', None, True),
+        ('FOOTPRINT', 'Footprint', 'footprints:', None),
+        ('Supplier 1', 'Supplier 1', None, True),
+        ('EXTRA', 'EXTRA', None, None),
+    ]
+    assert compile_config(resolve_config(None, 'table'), ['SYMBOL']) == \
+        [('SYMBOL', 'SYMBOL', None, None)]
+
+
+def test_batch(tmpdir, capsys):
+    tmpdir = str(tmpdir)
+    library = path.join(tmpdir, 'base.lib')
+    with open(library, 'w') as f:
+        f.write(TEST_LIB_DATA)
+    config = path.join(tmpdir, 'config.json')
+    with open(config, 'w') as f:
+        json.dump(CONFIG, f)
+    tables = [write_csv(path.join(tmpdir, '%s.csv' % name), make_rows(seed=seed))
+              for seed, name in enumerate(['first', 'second'])]
+
+    def read(output_name):
+        with open(output_name + '.lib') as lib, open(output_name + '.dcm') as dcm:
+            return lib.read(), dcm.read()
+
+    expected = []
+    for table in tables:
+        main([library, table, path.join(tmpdir, 'single'), '--config', config])
+        expected.append(read(path.join(tmpdir, 'single')))
+
+    for jobs in ('1', '2'):
+        output_dir = path.join(tmpdir, 'batch' + jobs)
+        os.mkdir(output_dir)
+        main(['batch', library, output_dir] + tables + ['--config', config, '--jobs', jobs])
+        assert [read(path.join(output_dir, x)) for x in ('first', 'second')] == expected
+
+    capsys.readouterr()
+    with pytest.raises(SystemExit):
+        main(['batch'])
+    assert 'the following arguments are required: library' in capsys.readouterr().err